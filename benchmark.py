@@ -0,0 +1,312 @@
+"""
+Benchmarks of the ingest, compression and spectral hot paths on synthetic
+recordings (see synthetic.py), so optimizations can be measured without the
+private data.
+
+Every benchmark is run at each recording duration and channel count, and its
+wall time, CPU time and peak memory are written to a JSON file. Timings and
+memory come from separate runs, and the memory run happens in a fresh process
+so that its peak resident set size, and that of any worker processes, can be
+reported along with the memory traced by Python:
+
+    python benchmark.py --durations 10 60 300 --channels 1 4 --out bench.json
+
+Comparing two runs, e.g. before and after a change:
+
+    python benchmark.py --compare before.json after.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import compression
+import compression_experiment
+import instrument
+import loader
+import spectral
+import synthetic
+import utils as util
+
+BENCH_REC_ID = '001'
+
+
+def _bench_load_mat(ctx):
+    loader.load_recording(BENCH_REC_ID, use_cache=False, channels=ctx['channels'])
+
+def _bench_load_raw(ctx):
+    data, _ = loader.load_recording_raw(BENCH_REC_ID, channels=ctx['channels'])
+    # Touch every sample, the memmap itself is free.
+    np.add.reduce(data, axis=-1)
+
+def _bench_find_conditions(ctx):
+    util.find_condition_endpoints(ctx['rec']['comments'])
+
+def _bench_sliding_compression(ctx):
+    data = ctx['rec']['data']
+    if data.ndim == 1:
+        compression.get_compression_ratios_for_array(data, window_size=20000,
+            inc=9000)
+    else:
+        compression.get_compression_ratios_per_channel(data,
+            window_size=20000, inc=9000)
+
+def _bench_block_compression(ctx):
+    # (C, N) data is windowed over all channels, as in compress_recording.
+    result = compression.get_block_compression_ratios_for_array(
+        ctx['rec']['data'], window_size=20000, inc=1000)
+    assert result.shape[0] > 0, 'block compression computed no windows'
+
+def _bench_compress_recording(ctx):
+    compression_experiment.compress_recording(ctx['rec']['data'],
+        window_size=150000, inc=30000)
+
+def _bench_condition_fft(ctx):
+    rec = ctx['rec']
+    spectral.condition_spectra(rec['cond'], rec['data'], method='fft',
+        max_freq=100)
+
+def _bench_condition_psd(ctx):
+    rec = ctx['rec']
+    spectral.condition_spectra(rec['cond'], rec['data'], method='psd',
+        max_freq=100)
+
+def _bench_spectrogram(ctx):
+    data = np.atleast_2d(ctx['rec']['data'])[0]
+    spectral.compute_spectrogram(data, decimate=30, max_freq=100)
+
+
+# Name -> function taking the benchmark context. The context holds the
+# synthetic recording ('rec'), the channels argument for the loaders and the
+# directory the recording was written to.
+BENCHMARKS = {
+    'load_mat': _bench_load_mat,
+    'load_raw': _bench_load_raw,
+    'find_conditions': _bench_find_conditions,
+    'sliding_compression': _bench_sliding_compression,
+    'block_compression': _bench_block_compression,
+    'compress_recording': _bench_compress_recording,
+    'condition_fft': _bench_condition_fft,
+    'condition_psd': _bench_condition_psd,
+    'spectrogram': _bench_spectrogram,
+}
+
+
+def measure(func, *args, repeat=1):
+    """
+    Runs func(*args) repeat times and returns the best wall time and CPU time
+    in seconds. CPU time is that of this process only, so it does not include
+    worker processes.
+
+    Memory is measured in one more run, see measure_memory, so that tracing
+    allocations does not slow down the timed runs.
+    """
+    wall = []
+    cpu = []
+    for _ in range(repeat):
+        w0 = time.perf_counter()
+        c0 = time.process_time()
+        func(*args)
+        cpu.append(time.process_time() - c0)
+        wall.append(time.perf_counter() - w0)
+
+    return min(wall), min(cpu)
+
+
+def measure_memory(func, *args):
+    """
+    Runs func(*args) once in a forked process and returns a dictionary with:
+        - 'peak_bytes': peak memory allocated through Python (which includes
+          numpy arrays)
+        - 'peak_rss_bytes': growth of the peak resident set size during the
+          run, which also counts memory-mapped pages that were read and
+          memory allocated outside of Python
+        - 'children_peak_rss_bytes': peak resident set size of the largest
+          worker process started by func, or 0 without workers
+
+    The peak RSS of a process can only grow, so every run gets a fresh
+    process. Where fork is not available, the RSS values are None.
+    """
+    if instrument.max_rss() is None or \
+            'fork' not in mp.get_all_start_methods():
+        return _measure_memory(func, args)
+
+    ctx = mp.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_measure_memory, args=(func, args, send))
+    p.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if result is None:
+        raise RuntimeError('memory run failed with exit code {}'.format(
+            p.exitcode))
+
+    return result
+
+def _measure_memory(func, args, conn=None):
+    rss0 = instrument.max_rss()
+    tracemalloc.start()
+    try:
+        func(*args)
+        result = {'peak_bytes': tracemalloc.get_traced_memory()[1]}
+    finally:
+        tracemalloc.stop()
+
+    if conn is None:
+        result['peak_rss_bytes'] = None
+        result['children_peak_rss_bytes'] = None
+        return result
+
+    result['peak_rss_bytes'] = instrument.max_rss() - rss0
+    result['children_peak_rss_bytes'] = instrument.max_rss(children=True)
+    conn.send(result)
+    conn.close()
+
+
+def run_benchmarks(durations, channels=(1,), names=None, repeat=1,
+        work_dir=None):
+    """
+    Runs the benchmarks in names (all of BENCHMARKS if None) on a synthetic
+    recording of every duration (in seconds) and channel count.
+
+    Returns a list of result dictionaries, one per benchmark and size.
+    """
+    if names is None: names = list(BENCHMARKS)
+    tmp = tempfile.TemporaryDirectory(dir=work_dir)
+    saved = {name: getattr(loader, name) for name in _LOADER_PATHS}
+
+    results = []
+    try:
+        for n_channels in channels:
+            for duration in durations:
+                ctx = _setup(duration, n_channels, tmp.name)
+                n = ctx['rec']['data'].shape[-1]
+                for name in names:
+                    wall, cpu = measure(BENCHMARKS[name], ctx, repeat=repeat)
+                    mem = measure_memory(BENCHMARKS[name], ctx)
+                    results.append({
+                        'benchmark': name,
+                        'duration_s': duration,
+                        'channels': n_channels,
+                        'samples': n,
+                        'wall_s': wall,
+                        'cpu_s': cpu,
+                        'samples_per_s': n * n_channels / wall if wall else None,
+                        **mem,
+                    })
+                    print('{:>20} {:>6}s x{:<3} {:9.3f}s wall {:9.1f} MB'.format(
+                        name, duration, n_channels, wall,
+                        _peak_memory(mem) / 2**20))
+    finally:
+        for name, value in saved.items():
+            setattr(loader, name, value)
+        tmp.cleanup()
+
+    return results
+
+
+def _peak_memory(mem):
+    # Best available estimate of the memory a benchmark needed, in bytes.
+    if mem['peak_rss_bytes'] is None:
+        return mem['peak_bytes']
+    return max(mem['peak_rss_bytes'], mem['children_peak_rss_bytes'])
+
+
+# Loader settings pointed at the synthetic files while the benchmarks run.
+_LOADER_PATHS = ('DATA_DIR', 'RAW_DATA_DIR', 'COMMENT_DIR', 'COMMENT_TABLE')
+
+def _setup(duration, n_channels, root):
+    rec = synthetic.generate_recording(duration, n_channels)
+    d = os.path.join(root, '{}s_{}ch'.format(duration, n_channels))
+    synthetic.write_mat_files(rec, BENCH_REC_ID, os.path.join(d, 'mat_files'),
+        os.path.join(d, 'comment_csv'))
+    synthetic.write_blackrock_files(rec, BENCH_REC_ID, os.path.join(d, 'raw'))
+
+    loader.DATA_DIR = os.path.join(d, 'mat_files')
+    loader.RAW_DATA_DIR = os.path.join(d, 'raw')
+    loader.COMMENT_DIR = os.path.join(d, 'comment_csv')
+    loader.COMMENT_TABLE = os.path.join(d, 'comment_csv', 'comments')
+
+    return {'rec': rec, 'dir': d,
+        'channels': 0 if n_channels == 1 else None}
+
+
+def environment():
+    """
+    Returns a description of the machine and code version the benchmarks ran
+    on, to store with the results.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(before_path, after_path):
+    """
+    Prints the wall time speedup of every benchmark in after_path relative to
+    before_path (both JSON files written by this script).
+    """
+    before = json.load(open(before_path))['results']
+    after = json.load(open(after_path))['results']
+    key = lambda r: (r['benchmark'], r['duration_s'], r['channels'])
+    old = {key(r): r for r in before}
+
+    for r in after:
+        if key(r) not in old: continue
+        o = old[key(r)]
+        print('{:>20} {:>6}s x{:<3} {:9.3f}s -> {:9.3f}s ({:.2f}x)'.format(
+            r['benchmark'], r['duration_s'], r['channels'], o['wall_s'],
+            r['wall_s'], o['wall_s'] / r['wall_s']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--durations', type=float, nargs='+', default=[10, 60],
+        help='recording durations in seconds')
+    parser.add_argument('--channels', type=int, nargs='+', default=[1])
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+        help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--work-dir', help='where synthetic files are written')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run_benchmarks(args.durations, args.channels, args.only,
+        args.repeat, args.work_dir)
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f,
+            indent=1)
+    print('Saved results to', args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Native readers for raw Blackrock NEV and NSx (.ns6) files.
+
+These replace the MATLAB/NPMK round-trip in preproc.m: headers are parsed
+directly and the NSx sample block is memory-mapped, so opening a multi-hour
+30 kHz recording does not read any samples until they are sliced.
+
+Supports NSx file spec 2.2/2.3 and 3.0 (non-PTP) and NEV file spec 2.x/3.0.
+"""
+import os
+
+import numpy as np
+
+# NSx sample periods are counted in ticks of the 30 kHz sampling clock, while
+# timestamps use time_resolution ticks per second (30 kHz in file spec 2.x,
+# nanoseconds in 3.0).
+SAMPLE_CLOCK = 30000
+
+NSX_BASIC_HEADER = np.dtype([
+    ('file_type_id', 'S8'),
+    ('file_spec', 'u1', 2),
+    ('bytes_in_headers', '<u4'),
+    ('label', 'S16'),
+    ('comment', 'S256'),
+    ('period', '<u4'),
+    ('time_resolution', '<u4'),
+    ('time_origin', '<u2', 8),
+    ('channel_count', '<u4'),
+])
+
+NSX_EXT_HEADER = np.dtype([
+    ('type', 'S2'),
+    ('electrode_id', '<u2'),
+    ('label', 'S16'),
+    ('frontend_id', 'u1'),
+    ('frontend_pin', 'u1'),
+    ('min_digital', '<i2'),
+    ('max_digital', '<i2'),
+    ('min_analog', '<i2'),
+    ('max_analog', '<i2'),
+    ('units', 'S16'),
+    ('highpass_freq', '<u4'),
+    ('highpass_order', '<u4'),
+    ('highpass_type', '<u2'),
+    ('lowpass_freq', '<u4'),
+    ('lowpass_order', '<u4'),
+    ('lowpass_type', '<u2'),
+])
+
+NEV_BASIC_HEADER = np.dtype([
+    ('file_type_id', 'S8'),
+    ('file_spec', 'u1', 2),
+    ('additional_flags', '<u2'),
+    ('bytes_in_headers', '<u4'),
+    ('bytes_in_data_packets', '<u4'),
+    ('time_resolution_timestamps', '<u4'),
+    ('time_resolution_samples', '<u4'),
+    ('time_origin', '<u2', 8),
+    ('application', 'S32'),
+    ('comment', 'S256'),
+    ('extended_header_count', '<u4'),
+])
+
+NEV_COMMENT_PACKET_ID = 0xFFFF
+
+
+def read_nsx_header(path):
+    """
+    Reads the basic and extended headers of an NSx file.
+
+    Returns a dictionary with:
+        - 'file_spec': (major, minor) tuple
+        - 'sample_rate': samples per second
+        - 'time_resolution': timestamp ticks per second
+        - 'channels': list of per-channel dicts (electrode id, label, units,
+          and the digital -> analog 'scale' / 'offset')
+        - 'data_offset': byte offset of the first data packet
+    """
+    with open(path, 'rb') as f:
+        basic = np.fromfile(f, dtype=NSX_BASIC_HEADER, count=1)[0]
+        if basic['file_type_id'] != b'NEURALCD':
+            raise ValueError("Unsupported NSx file type: " +
+                str(basic['file_type_id']) + " (only NEURALCD is supported)")
+
+        n_chan = int(basic['channel_count'])
+        ext = np.fromfile(f, dtype=NSX_EXT_HEADER, count=n_chan)
+
+    channels = []
+    for e in ext:
+        digital_range = int(e['max_digital']) - int(e['min_digital'])
+        analog_range = int(e['max_analog']) - int(e['min_analog'])
+        scale = analog_range / digital_range if digital_range else 1.0
+        channels.append({
+            'electrode_id': int(e['electrode_id']),
+            'label': _decode(e['label']),
+            'units': _decode(e['units']),
+            'scale': scale,
+            'offset': int(e['min_analog']) - int(e['min_digital']) * scale,
+        })
+
+    return {
+        'file_spec': tuple(int(v) for v in basic['file_spec']),
+        'label': _decode(basic['label']),
+        'sample_rate': SAMPLE_CLOCK // int(basic['period']),
+        'time_resolution': int(basic['time_resolution']),
+        'channels': channels,
+        'data_offset': int(basic['bytes_in_headers']),
+    }
+
+
+def open_nsx(path):
+    """
+    Opens an NSx file and memory-maps its sample data without reading it.
+
+    Returns the header dictionary from read_nsx_header with an extra
+    'segments' key: a list of dicts with the 'timestamp' of the segment and a
+    read-only (channels x samples) int16 'data' view into the file. Recordings
+    that were never paused have exactly one segment.
+    """
+    header = read_nsx_header(path)
+    n_chan = len(header['channels'])
+    ts_dtype = '<u8' if header['file_spec'][0] >= 3 else '<u4'
+    ts_size = np.dtype(ts_dtype).itemsize
+    file_size = os.path.getsize(path)
+
+    segments = []
+    offset = header['data_offset']
+    with open(path, 'rb') as f:
+        while offset < file_size:
+            f.seek(offset)
+            packet = f.read(1 + ts_size + 4)
+            if len(packet) < 1 + ts_size + 4 or packet[0] != 0x01:
+                break
+            timestamp = int(np.frombuffer(packet, ts_dtype, 1, 1)[0])
+            n_samples = int(np.frombuffer(packet, '<u4', 1, 1 + ts_size)[0])
+            offset += len(packet)
+
+            # Truncated files (e.g. a crashed recording) report more samples
+            # than were actually written.
+            n_samples = min(n_samples, (file_size - offset) // (2 * n_chan))
+            if n_samples > 0:
+                # The file stores samples interleaved by channel, so the
+                # transposed memmap is a zero-copy (channels x samples) view.
+                data = np.memmap(path, dtype='<i2', mode='r', offset=offset,
+                    shape=(n_samples, n_chan)).T
+                segments.append({'timestamp': timestamp, 'data': data})
+            offset += n_samples * n_chan * 2
+
+    header['segments'] = segments
+    return header
+
+
+def get_nsx_data(nsx, channels=0, segment=0, uv=False):
+    """
+    Returns the samples of one channel from an opened NSx (see open_nsx) as a
+    (N, ) array, or of several channels as a (C, N) array if channels is a
+    list of channel indexes or None (all channels). Recordings that were
+    paused have several segments; the first one is returned by default.
+
+    By default this is an int16 view into the memory-mapped file in digital
+    units, which is zero-copy for a single channel or for all channels; the
+    conversion to analog units of each channel is its 'scale' and 'offset' in
+    nsx['channels']. With uv=True the samples are converted to analog units
+    (uV for EOG channels), matching openNSx('uv') in preproc.m. This reads
+    every sample into a new float64 array of the full recording.
+    """
+    if channels is None: channels = slice(None)
+    data = nsx['segments'][segment]['data'][channels]
+    if not uv:
+        return data
+
+    info = np.array(nsx['channels'], dtype=object)[channels]
+    scale = np.array([c['scale'] for c in np.atleast_1d(info)])
+    offset = np.array([c['offset'] for c in np.atleast_1d(info)])
+    if data.ndim == 1:
+        return data * scale[0] + offset[0]
+
+    # The memmap view is channel-interleaved; write the converted samples into
+    # a contiguous (C, N) array instead.
+    out = np.empty(data.shape)
+    np.multiply(data, scale[:, None], out=out)
+    out += offset[:, None]
+    return out
+
+
+def read_nev_comments(path, nsx=None, segment=0):
+    """
+    Reads the comment packets from a raw NEV file.
+
+    Returns the same dictionary as utils.get_comments does for a NEV .mat
+    object:
+        - 'text': (N, ) array containing the raw text of the comments
+        - 'start': (N, ) array containing the start times of the comments
+        - 'end': (N, ) array containing the end times of the comments
+
+    The times are NEV timestamps, in ticks of the file's
+    time_resolution_timestamps (30 kHz in file spec 2.x, nanoseconds in 3.0).
+    If the NSx recorded alongside is given (see open_nsx), they are converted
+    to sample indexes into get_nsx_data(nsx, segment=segment) instead.
+    """
+    with open(path, 'rb') as f:
+        basic = np.fromfile(f, dtype=NEV_BASIC_HEADER, count=1)[0]
+    if basic['file_type_id'] not in (b'NEURALEV', b'BREVENTS'):
+        raise ValueError("Unsupported NEV file type: " +
+            str(basic['file_type_id']))
+
+    ts_dtype = '<u8' if basic['file_spec'][0] >= 3 else '<u4'
+    packet_size = int(basic['bytes_in_data_packets'])
+    offset = int(basic['bytes_in_headers'])
+    n_packets = (os.path.getsize(path) - offset) // packet_size
+
+    ts_size = np.dtype(ts_dtype).itemsize
+    packet_dtype = np.dtype([
+        ('timestamp', ts_dtype),
+        ('packet_id', '<u2'),
+        ('char_set', 'u1'),
+        ('flag', 'u1'),
+        ('data', '<u4'),
+        ('text', 'S' + str(packet_size - ts_size - 8)),
+    ])
+    packets = np.memmap(path, dtype=packet_dtype, mode='r', offset=offset,
+        shape=(n_packets,))
+    comments = packets[packets['packet_id'] == NEV_COMMENT_PACKET_ID]
+
+    text = np.array([_decode(t, 'latin-1') for t in comments['text']])
+    # Newer Central versions store the time at which the comment was started
+    # in the data field, as NPMK's TimeStampStarted.
+    start = comments['data'].astype(np.int64)
+    end = comments['timestamp'].astype(np.int64)
+
+    if nsx is not None:
+        rate = nsx['sample_rate']
+        resolution = int(basic['time_resolution_timestamps'])
+        # Sample index of the first sample of the segment, counted from the
+        # same clock origin as the NEV timestamps.
+        origin = _ticks_to_samples(nsx['segments'][segment]['timestamp'],
+            nsx['time_resolution'], rate)
+        start = _ticks_to_samples(start, resolution, rate) - origin
+        end = _ticks_to_samples(end, resolution, rate) - origin
+
+    return {'text': text, 'start': start, 'end': end}
+
+
+def _ticks_to_samples(ticks, resolution, rate):
+    # Rounds to the nearest sample; integer math keeps nanosecond timestamps
+    # exact.
+    return (ticks * rate + resolution // 2) // resolution
+
+
+def _decode(raw, encoding='ascii'):
+    return raw.split(b'\x00', 1)[0].decode(encoding, errors='replace').strip()
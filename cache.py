@@ -0,0 +1,146 @@
+"""
+Local cache of parsed recordings.
+
+Entries are keyed on the size and modification time (or optionally the
+content hash) of every source file that went into a recording, plus
+PARSER_VERSION. Each entry is a raw .npy file of the extracted data and a
+.json file of the conditions dict. When the cache grows beyond its size limit
+the least recently used entries are evicted.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import store
+
+CACHE_DIR = "cache/"
+MAX_CACHE_BYTES = 20 * 2**30
+
+# Bump this whenever a change to the parsing code changes its output, so that
+# stale cache entries are never returned.
+PARSER_VERSION = 1
+
+
+def cache_key(paths, hash_contents=False, extra=()):
+    """
+    Returns a key identifying the current state of the files in paths. Files
+    that do not exist are part of the key too, so creating one (for example a
+    hand-edited conditions file) invalidates the entry.
+
+    With hash_contents=True the file contents are hashed instead of relying on
+    size and modification time. This is slow for large recordings.
+    """
+    h = hashlib.sha1()
+    h.update(repr((PARSER_VERSION, tuple(extra))).encode())
+
+    for path in paths:
+        h.update(os.path.abspath(path).encode())
+        if not os.path.exists(path):
+            h.update(b'<missing>')
+        elif hash_contents:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    h.update(block)
+        else:
+            st = os.stat(path)
+            h.update(repr((st.st_size, st.st_mtime_ns)).encode())
+
+    return h.hexdigest()
+
+
+def get(key, cache_dir=CACHE_DIR):
+    """
+    Returns the cached (data, cond) for key, or None if it is not cached. The
+    data is memory-mapped copy-on-write, so it loads instantly and can still
+    be modified in memory.
+    """
+    data_path, cond_path = _entry_paths(key, cache_dir)
+    if not (os.path.exists(data_path) and os.path.exists(cond_path)):
+        return None
+
+    try:
+        data = np.load(data_path, mmap_mode='c')
+        with open(cond_path) as f:
+            cond = json.load(f)
+
+        # Mark as recently used for eviction.
+        os.utime(data_path)
+    except FileNotFoundError:
+        # Evicted by another process in the meantime.
+        return None
+    return data, cond
+
+
+def put(key, data, cond, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    Stores data and cond under key, then evicts least recently used entries
+    until the cache fits in max_bytes.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    data_path, cond_path = _entry_paths(key, cache_dir)
+
+    # Write to temporary files first so that concurrent readers (e.g. pool
+    # workers) never see a partially written entry.
+    tmp_cond = cond_path + '.tmp' + str(os.getpid())
+    with open(tmp_cond, 'w') as f:
+        json.dump(cond, f, default=store.to_json)
+    tmp_data = data_path + '.tmp' + str(os.getpid())
+    with open(tmp_data, 'wb') as f:
+        np.save(f, np.asarray(data))
+    os.replace(tmp_cond, cond_path)
+    os.replace(tmp_data, data_path)
+
+    evict(max_bytes, cache_dir)
+
+
+def evict(max_bytes=MAX_CACHE_BYTES, cache_dir=CACHE_DIR):
+    """
+    Deletes least recently used entries until the cache is at most max_bytes.
+
+    Every process that puts entries evicts, e.g. the workers of
+    loader.iter_recordings, so entries may disappear while this runs; they
+    are skipped.
+    """
+    if not os.path.exists(cache_dir):
+        return
+
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npy'):
+            continue
+        key = name[:-len('.npy')]
+        data_path, cond_path = _entry_paths(key, cache_dir)
+        try:
+            st = os.stat(data_path)
+            size = st.st_size
+            if os.path.exists(cond_path):
+                size += os.path.getsize(cond_path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, size, key))
+        total += size
+
+    for _, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        for path in _entry_paths(key, cache_dir):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def clear(cache_dir=CACHE_DIR):
+    evict(0, cache_dir)
+
+
+def _entry_paths(key, cache_dir):
+    base = os.path.join(cache_dir, key)
+    return base + '.npy', base + '.json'
+
@@ -1,17 +1,107 @@
 """
 Script for compression experiment.
 """
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from multiprocessing import cpu_count
+from math import gcd
+from multiprocessing import cpu_count, shared_memory
 from pathlib import Path
+import bz2
 import gzip
+import lzma
 import pdb
-from typing import Any, Optional, Dict
+import time
+from typing import Any, Callable, Optional, Dict
+import warnings
+import zlib
 
 import numpy as np
 import numpy.typing as npt
-import plotly.graph_objects as go
-from tqdm.contrib.concurrent import process_map
+from tqdm import tqdm
+
+import instrument
+
+# Smallest block size of the block estimators. Below a few hundred samples per
+# block the estimated ratios are far off, see
+# get_block_compression_ratios_for_array.
+MIN_BLOCK_SIZE = 250
+
+# Registry of compression codecs, see register_codec.
+CODECS: Dict[str, Dict[str, Any]] = {}
+
+
+def register_codec(
+    name: str,
+    compress: Callable[[bytes, int], bytes],
+    default_level: Optional[int] = None,
+    overhead_bytes: int = 0
+):
+    """
+    Adds a compression codec that can be used as the method argument of the
+    compression functions in this module.
+
+    Args:
+        name: Name of the codec. Methods are specified as "name" for the
+            default level or "name:level", e.g. "gzip:1".
+        compress: Function taking the raw bytes and a compression level and
+            returning the compressed bytes.
+        default_level: Level used when the method does not specify one.
+        overhead_bytes: Size of the header and trailer that every compressed
+            stream carries regardless of its content.
+    """
+    CODECS[name] = {
+        'compress': compress,
+        'default_level': default_level,
+        'overhead_bytes': overhead_bytes,
+    }
+
+
+def get_codec(method: str) -> Callable[[bytes], bytes]:
+    """
+    Returns a function compressing bytes with the codec and level specified by
+    method ("name" or "name:level").
+    """
+    name, _, level = method.partition(':')
+    if name not in CODECS:
+        raise ValueError("Unsupported compression method: " + method +
+            ". Available codecs: " + ", ".join(sorted(CODECS)))
+
+    codec = CODECS[name]
+    level = int(level) if level else codec['default_level']
+    return partial(codec['compress'], level=level)
+
+
+def get_codec_overhead(method: str) -> int:
+    return CODECS[method.partition(':')[0]]['overhead_bytes']
+
+
+def _deflate(data_bytes, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data_bytes) + compressor.flush()
+
+
+register_codec("gzip", lambda b, level: gzip.compress(b, level), 9, 18)
+register_codec("zlib", lambda b, level: zlib.compress(b, level), 6, 6)
+# Raw deflate stream (what gzip and zlib wrap) without any header.
+register_codec("deflate", _deflate, 6, 0)
+register_codec("bz2", lambda b, level: bz2.compress(b, level), 9, 14)
+register_codec("lzma", lambda b, level: lzma.compress(b, preset=level), 6, 60)
+
+# Fast codecs from optional packages, if they are installed.
+try:
+    import lz4.frame
+    register_codec("lz4",
+        lambda b, level: lz4.frame.compress(b, compression_level=level), 0, 15)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    register_codec("zstd",
+        lambda b, level: zstandard.ZstdCompressor(level=level).compress(b), 3,
+        9)
+except ImportError:
+    pass
 
 
 def get_compression_ratios_for_array(
@@ -69,21 +159,440 @@ def get_compression_ratios_for_array(
     # ratio in the first column corresponds to.
     result[:,1] = (np.arange(num_slices) * inc) + window_size
 
-    # Prepare data slices for compression.
-    data = data.astype('float32')
-    slices = []
-    for i in range(num_slices):
-        data_slice = data[i * inc:i * inc + window_size]
-        slices.append(data_slice)
-
     # Compress all the data slices and derive compression ratios for them.
+    # Workers only receive the (start, end) bounds of their windows and read
+    # the samples from a single shared float32 copy of the data.
+    bounds = [(i * inc, i * inc + window_size) for i in range(num_slices)]
     func = partial(get_compression_ratio_for_slice, method)
-    compression_ratios = process_map(func, slices, max_workers=cpu_count())
+    compression_ratios = map_shared_slices(func, data, bounds)
     result[:,0] = np.asarray(compression_ratios)
 
     return result
 
 
+def get_compression_ratios_per_channel(
+    data,
+    window_size: int = 20000,
+    inc: int = 9000,
+    method: str = "gzip"
+) -> npt.NDArray:
+    """
+    Computes a time-series of compression ratios for every channel of a
+    multi-channel recording, like get_compression_ratios_for_array does for a
+    single channel. All windows of all channels are compressed in one pool.
+
+    Args:
+        data: A (C x N) Numpy array of C channels of N samples each.
+        window_size: Size of window over which to compression and compute a
+            compression ratio for.
+        inc: By how many samples to increment the start of a subequent
+            compression window.
+        method: Which compression method to use.
+
+    Returns:
+        A (C x N // inc x 2) numpy array, where result[c] is the result of
+        get_compression_ratios_for_array for channel c.
+    """
+    n_chan = data.shape[0]
+    num_slices = data.shape[1] // inc
+
+    result = np.zeros((n_chan, num_slices, 2))
+    result[:, :, 1] = (np.arange(num_slices) * inc) + window_size
+
+    # Channels are laid out back to back in shared memory, so each window is
+    # clipped to the end of its own channel.
+    n = data.shape[1]
+    bounds = []
+    for c in range(n_chan):
+        for i in range(num_slices):
+            bounds.append((c * n + i * inc, c * n + min(i * inc + window_size, n)))
+
+    func = partial(get_compression_ratio_for_slice, method)
+    compression_ratios = map_shared_slices(func, data.reshape(-1), bounds)
+    result[:, :, 0] = np.asarray(compression_ratios).reshape(n_chan, num_slices)
+
+    return result
+
+
+def get_block_compression_ratios_for_array(
+    data,
+    window_size: int = 20000,
+    inc: int = 9000,
+    method: str = "gzip",
+    block_size: Optional[int] = None
+) -> npt.NDArray:
+    """
+    Fast approximation of get_compression_ratios_for_array for overlapping
+    windows.
+
+    Instead of compressing every window from scratch, the data is split into
+    blocks of block_size samples (by default gcd(window_size, inc), so every
+    window is made of whole blocks) and every block is compressed exactly
+    once. The compressed size of a window is then estimated as the sum of the
+    compressed sizes of its blocks, minus the per-stream header overhead that
+    a single compressed window would only pay once:
+
+                0 1 2 3 4 5 6 7 8 9
+        data = [][][][][][][][][][][][][][][][][][][][][][][]
+        blocks  |b0 |b1 |b2 |b3 |b4 |b5 |b6 | ...
+               {  window 0  }
+                    {  window 1  }    window 1 = b1 + b2 + b3
+
+    The work is O(N) regardless of how much the windows overlap, instead of
+    O(N * window_size / inc).
+
+    Error: each block restarts the compressor's dictionary and entropy coder,
+    which tends to make the estimate too high, while rounding windows out to
+    whole blocks can move it either way. The error grows quickly as blocks get
+    smaller. Estimated minus exact gzip ratios over every window of
+    synthetic.generate_recording(30, 1) with seeds 0 to 9 (the last two rows
+    are below MIN_BLOCK_SIZE and only shown for comparison):
+
+        window_size  inc   block_size  error
+        150000       7000  1000        -0.002 to +0.015
+        20000        9000  1000        -0.022 to +0.016
+        20000        9000  250         +0.005 to +0.050
+        5000         400   400         -0.022 to +0.042
+        5000         400   200         +0.007 to +0.073
+        5000         400   100         +0.061 to +0.134
+
+    These ranges come from synthetic data, so real recordings can fall
+    outside of them.
+
+    Blocks smaller than MIN_BLOCK_SIZE samples are not used: if the default
+    gcd(window_size, inc) is smaller, the exact ratios of every window are
+    computed instead. Use get_block_compression_error to measure the error on
+    real data.
+
+    Args:
+        data: A (N, ) or (C x N) Numpy array of data to compress. Windows are
+            taken along the last (time) axis and contain all channels, as in
+            compression_experiment.compress_recording.
+        window_size: Size of window over which to compression and compute a
+            compression ratio for.
+        inc: By how many samples to increment the start of a subequent
+            compression window.
+        method: Which compression method to use.
+        block_size: Number of samples per independently compressed block,
+            at least MIN_BLOCK_SIZE. Windows are rounded out to whole blocks
+            if it does not divide both window_size and inc.
+
+    Returns:
+        A (N // inc x 2) array like get_compression_ratios_for_array returns
+        for (N, ) data.
+    """
+    if block_size is None:
+        block_size = gcd(window_size, inc)
+        if block_size < MIN_BLOCK_SIZE:
+            warnings.warn("gcd(window_size, inc) = {} is below MIN_BLOCK_SIZE, "
+                "computing exact compression ratios instead".format(block_size))
+            num_slices = data.shape[-1] // inc
+            bounds = [(i * inc, i * inc + window_size)
+                for i in range(num_slices)]
+            func = partial(get_compression_ratio_for_slice, method)
+            ratios = map_shared_slices(func, data, bounds, axis=-1)
+            return np.stack([ratios, np.arange(num_slices) * inc + window_size],
+                axis=1)
+    _check_block_size(block_size)
+
+    blocks = _compress_blocks(data, block_size, method)
+    ratios, timestamps = _block_window_ratios(blocks, window_size, inc)
+
+    return np.stack([ratios, timestamps], axis=1)
+
+
+def get_compression_pyramid(
+    data,
+    window_sizes,
+    incs,
+    method: str = "gzip",
+    block_size: Optional[int] = None
+) -> Dict[str, npt.NDArray]:
+    """
+    Computes compression ratio time-series for every combination of window
+    size and increment in a single pass over the data.
+
+    Like get_block_compression_ratios_for_array, every block of block_size
+    samples is compressed once (in parallel), and the ratios of all
+    (window_size, inc) pairs are derived from the same block results, so the
+    cost barely depends on how many pairs are requested. See
+    get_block_compression_ratios_for_array for the error bound.
+
+    Args:
+        data: A (N, ) or (C x N) Numpy array of data to compress. Windows are
+            taken along the last (time) axis and contain all channels.
+        window_sizes: List of window sizes.
+        incs: List of window increments.
+        method: Which compression method to use.
+        block_size: Number of samples per compressed block, at least
+            MIN_BLOCK_SIZE. Defaults to the gcd of all window sizes and
+            increments, raised to MIN_BLOCK_SIZE (with a warning) if it is
+            smaller. Since smaller blocks increase the error, pass a larger
+            block_size when some increments are small; windows are then
+            rounded out to whole blocks.
+
+    Returns:
+        A dictionary with:
+            - 'window_size': (P,) window size of each of the P pairs
+            - 'inc': (P,) increment of each pair
+            - 'ratios': (P x T) compression ratios of each pair, where T is
+              the number of windows of the smallest increment. Rows of pairs
+              with fewer windows are padded with NaN.
+            - 'timestamps': (P x T) sample indexes of the ratios, as in the
+              second column of get_compression_ratios_for_array.
+    """
+    pairs = [(w, i) for w in window_sizes for i in incs]
+    if block_size is None:
+        block_size = 0
+        for v in list(window_sizes) + list(incs):
+            block_size = gcd(block_size, v)
+        if block_size < MIN_BLOCK_SIZE:
+            warnings.warn("gcd of the window sizes and increments is {}, using "
+                "blocks of MIN_BLOCK_SIZE = {} samples instead".format(
+                block_size, MIN_BLOCK_SIZE))
+            block_size = MIN_BLOCK_SIZE
+    _check_block_size(block_size)
+
+    blocks = _compress_blocks(data, block_size, method)
+
+    num_times = data.shape[-1] // min(incs)
+    result = {
+        'window_size': np.asarray([w for w, _ in pairs]),
+        'inc': np.asarray([i for _, i in pairs]),
+        'ratios': np.full((len(pairs), num_times), np.nan),
+        'timestamps': np.full((len(pairs), num_times), np.nan),
+    }
+    for p, (w, i) in enumerate(pairs):
+        ratios, timestamps = _block_window_ratios(blocks, w, i)
+        result['ratios'][p, :ratios.shape[0]] = ratios
+        result['timestamps'][p, :timestamps.shape[0]] = timestamps
+
+    return result
+
+
+def _check_block_size(block_size):
+    if block_size < MIN_BLOCK_SIZE:
+        raise ValueError("block_size must be at least MIN_BLOCK_SIZE ({}), "
+            "got {}".format(MIN_BLOCK_SIZE, block_size))
+
+
+def _compress_blocks(data, block_size, method):
+    # Compresses every block of block_size samples (of all channels) once and
+    # returns the prefix sums of compressed and raw block sizes (with the
+    # per-stream overhead removed), from which _block_window_ratios derives any
+    # window.
+    n = data.shape[-1]
+    num_blocks = -(-n // block_size)
+    bounds = [(j * block_size, min((j + 1) * block_size, n))
+        for j in range(num_blocks)]
+
+    func = partial(get_compressed_size_for_slice, method)
+    overhead = get_codec_overhead(method)
+    comp_sizes = np.asarray(map_shared_slices(func, data, bounds, axis=-1)) - \
+        overhead
+    sample_bytes = 4 * int(np.prod(data.shape[:-1]))
+    raw_sizes = np.asarray([(b - a) * sample_bytes for a, b in bounds])
+
+    return {
+        'n': n,
+        'block_size': block_size,
+        'overhead': overhead,
+        'comp_cum': np.concatenate([[0], np.cumsum(comp_sizes)]),
+        'raw_cum': np.concatenate([[0], np.cumsum(raw_sizes)]),
+    }
+
+
+def _block_window_ratios(blocks, window_size, inc):
+    # Prefix sums turn every window estimate into two lookups.
+    num_slices = blocks['n'] // inc
+    starts = np.arange(num_slices) * inc
+    ends = np.minimum(starts + window_size, blocks['n'])
+    first = starts // blocks['block_size']
+    last = -(-ends // blocks['block_size'])
+
+    comp_cum = blocks['comp_cum']
+    raw_cum = blocks['raw_cum']
+    ratios = (comp_cum[last] - comp_cum[first] + blocks['overhead']) / \
+        (raw_cum[last] - raw_cum[first])
+
+    return ratios, starts + window_size
+
+
+def get_block_compression_error(
+    data,
+    window_size: int = 20000,
+    inc: int = 9000,
+    method: str = "gzip",
+    block_size: Optional[int] = None,
+    num_windows: int = 50
+) -> npt.NDArray:
+    """
+    Measures the error of get_block_compression_ratios_for_array against
+    exact compression on num_windows evenly spaced windows of data.
+
+    Returns:
+        A (num_windows,) array of estimated minus exact compression ratios.
+    """
+    estimate = get_block_compression_ratios_for_array(data, window_size, inc,
+        method, block_size)
+    idx = np.linspace(0, estimate.shape[0] - 1, num_windows).astype(int)
+
+    data = data.astype('float32')
+    exact = np.asarray([get_compression_ratio_for_slice(method,
+        data[..., i * inc:i * inc + window_size]) for i in idx])
+
+    return estimate[idx, 0] - exact
+
+
+def stream_compression_ratios(
+    chunks,
+    window_size: int = 20000,
+    inc: int = 9000,
+    method: str = "gzip"
+):
+    """
+    Streaming version of get_compression_ratios_for_array.
+
+    Consumes chunks of samples from any iterable (see iter_array_chunks and
+    simulate_live_feed) and yields a (ratio, sample_idx) tuple as soon as each
+    window is complete, where sample_idx is the index of the sample following
+    the window, as in the second column of get_compression_ratios_for_array.
+    Memory use is bounded by one window, so this works on live feeds and on
+    recordings larger than RAM.
+
+    Unlike get_compression_ratios_for_array, the truncated windows at the end
+    of the data are not compressed, since a stream has no known end.
+
+    Args:
+        chunks: Iterable of (n, ) or (C x n) arrays of consecutive samples,
+            with time along the last axis. Chunks may have any length.
+        window_size: Size of window over which to compression and compute a
+            compression ratio for.
+        inc: By how many samples to increment the start of a subequent
+            compression window.
+        method: Which compression method to use.
+    """
+    buf = None
+    buf_start = 0   # Sample index of buf[0]
+    filled = 0      # Number of valid samples in buf
+    next_start = 0  # Sample index at which the next window starts
+
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        if buf is None:
+            buf = np.empty(chunk.shape[:-1] + (window_size,), dtype=np.float32)
+
+        n = chunk.shape[-1]
+        pos = 0
+        while pos < n:
+            # With inc > window_size, skip the samples between two windows.
+            if filled == 0 and buf_start < next_start:
+                skip = min(next_start - buf_start, n - pos)
+                buf_start += skip
+                pos += skip
+                continue
+
+            take = min(window_size - filled, n - pos)
+            buf[..., filled:filled + take] = chunk[..., pos:pos + take]
+            filled += take
+            pos += take
+
+            if filled == window_size:
+                yield get_compression_ratio_for_slice(method, buf), \
+                    buf_start + window_size
+
+                next_start += inc
+                drop = min(inc, window_size)
+                buf[..., :window_size - drop] = buf[..., drop:]
+                filled -= drop
+                buf_start += drop
+
+
+def iter_array_chunks(data, chunk_size: int = 30000):
+    """
+    Yields consecutive chunks of chunk_size samples (along the last axis)
+    from a (N, ) or (C x N) array. For np.memmap arrays (e.g. from a
+    recordings store), only the current chunk is read from disk.
+    """
+    for start in range(0, data.shape[-1], chunk_size):
+        yield np.asarray(data[..., start:start + chunk_size])
+
+
+def simulate_live_feed(data, chunk_size: int = 3000, sample_rate: int = 30000,
+        speed: float = 1.0):
+    """
+    Yields chunks of data at the pace of a live recording at sample_rate
+    samples per second (sped up by speed), to test streaming processing.
+    """
+    chunk_period = chunk_size / sample_rate / speed
+    next_time = time.perf_counter()
+    for chunk in iter_array_chunks(data, chunk_size):
+        next_time += chunk_period
+        time.sleep(max(next_time - time.perf_counter(), 0))
+        yield chunk
+
+
+def map_shared_slices(func, data, bounds, max_workers=None, axis=0) -> list:
+    """
+    Calls func on data[start:end] as float32 for every (start, end) in bounds,
+    in a pool of worker processes. With axis=-1, data[..., start:end] is used
+    instead, e.g. to take windows of all channels of a (C x N) recording.
+
+    The float32 data is written once to shared memory, which every worker
+    maps. Only the bounds are sent to the workers, so IPC and memory stay
+    proportional to the size of data, however many (overlapping) slices there
+    are.
+
+    Returns:
+        A list with the result of func for every slice, in order.
+    """
+    if max_workers is None:
+        max_workers = cpu_count()
+
+    shm = shared_memory.SharedMemory(create=True,
+        size=max(int(np.prod(data.shape)) * 4, 1))
+    try:
+        # Converts straight into shared memory, without an intermediate
+        # astype('float32') copy.
+        shared = np.ndarray(data.shape, dtype=np.float32, buffer=shm.buf)
+        with instrument.span('to_shared_memory', nbytes=shared.nbytes):
+            np.copyto(shared, data, casting='unsafe')
+
+        with instrument.span('map_shared_slices', slices=len(bounds),
+                workers=max_workers), \
+                ProcessPoolExecutor(max_workers=max_workers,
+                initializer=_attach_shared_data,
+                initargs=(shm.name, data.shape, axis)) as executor:
+            chunksize = max(1, len(bounds) // (4 * max_workers))
+            results = list(tqdm(executor.map(partial(_call_on_shared_slice,
+                func), bounds, chunksize=chunksize), total=len(bounds)))
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
+
+
+# Shared memory block and its float32 array view, set in each worker process
+# by _attach_shared_data.
+_shared_data = {}
+
+
+def _attach_shared_data(name, shape, axis=0):
+    shm = shared_memory.SharedMemory(name=name)
+    _shared_data['shm'] = shm
+    _shared_data['data'] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    _shared_data['axis'] = axis
+
+
+def _call_on_shared_slice(func, bounds):
+    start, end = bounds
+    if _shared_data['axis'] == 0:
+        return func(_shared_data['data'][start:end])
+    return func(_shared_data['data'][..., start:end])
+
+
 def get_compression_ratio_for_slice(
     method: str,
     data_slice: npt.NDArray[np.float32]
@@ -100,20 +609,95 @@ def get_compression_ratio_for_slice(
     Returns:
         The compression ratio for the data slice.
     """
+    size_raw = data_slice.nbytes
+    size_gz = get_compressed_size_for_slice(method, data_slice)
+    ratio = size_gz / size_raw
+
+    return ratio
+
+
+def get_compressed_size_for_slice(
+    method: str,
+    data_slice: npt.NDArray[np.float32]
+) -> int:
+    """
+    Compresses the provided slice and returns its compressed size in bytes.
+
+    Args:
+        method: Which compression method to use.
+        data_slice: numpy array of data to use.
+
+    Returns:
+        The size of the compressed data slice in bytes.
+    """
     data_bytes = data_slice.tobytes()
 
     # Compress
-    if method == "gzip":
-        data_bytes_compressed = gzip.compress(data_bytes)
-    else:
-        raise ValueError("Unsupported compression method.")
-
-    # Get raw size, ratio size
-    size_raw = len(data_bytes)
-    size_gz = len(data_bytes_compressed)
-    ratio = size_gz / size_raw
+    with instrument.span('compress', nbytes=len(data_bytes), method=method):
+        data_bytes_compressed = get_codec(method)(data_bytes)
 
-    return ratio
+    return len(data_bytes_compressed)
+
+
+def benchmark_codecs(
+    data,
+    methods=None,
+    window_size: int = 150000,
+    num_windows: int = 10,
+    cond: Optional[Dict[str, Any]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Measures compression ratio and throughput of every codec on the same data,
+    to choose the cheapest codec that still separates conditions.
+
+    Args:
+        data: A (N, ) or (C x N) Numpy array of data to compress. Windows are
+            taken along the last (time) axis and contain all channels.
+        methods: List of methods ("name" or "name:level") to benchmark.
+            Defaults to every registered codec at its default level.
+        window_size: Size of the windows that are compressed.
+        num_windows: Number of evenly spaced windows of data to compress.
+        cond: Optional dictionary of conditions (see loader.load_recording).
+            If given, the ratio of every condition's first window_size samples
+            is reported as well.
+
+    Returns:
+        A dictionary of method -> dictionary with the mean compression 'ratio',
+        the compression throughput in 'mb_per_s' (of raw float32 input), and
+        'condition_ratios' if cond was given.
+    """
+    if methods is None:
+        methods = sorted(CODECS)
+
+    data = np.asarray(data)
+    starts = np.linspace(0, max(data.shape[-1] - window_size, 0),
+        num_windows).astype(int)
+    windows = [data[..., s:s + window_size].astype('float32').tobytes()
+        for s in starts]
+    raw_bytes = sum(len(w) for w in windows)
+
+    results = {}
+    for method in methods:
+        compress = get_codec(method)
+
+        t0 = time.perf_counter()
+        comp_bytes = sum(len(compress(w)) for w in windows)
+        elapsed = time.perf_counter() - t0
+
+        results[method] = {
+            'ratio': comp_bytes / raw_bytes,
+            'mb_per_s': raw_bytes / 1e6 / elapsed,
+        }
+
+        if cond is not None:
+            results[method]['condition_ratios'] = {
+                key: get_compression_ratio_for_slice(method,
+                    data[..., cond[key]['start']:min(cond[key]['end'],
+                        cond[key]['start'] + window_size)].astype('float32'))
+                for key in cond
+            }
+
+    return results
 
 
 def plot_compression_ratios(
@@ -142,6 +726,7 @@ def plot_compression_ratios(
     Returns:
         A plotly graph object.
     """
+    import plotly.graph_objects as go
 
     # Convert the sample indexes to seconds for the provided sample rate.
     np_tstamps = np.asarray(compression_sample_idxs) / sample_rate
@@ -1,18 +1,24 @@
 """
 Script for compression experiment. 
 """
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import cpu_count
 from pathlib import Path
-import gzip
 import pdb
+import time
 
 import numpy as np
-import plotly.graph_objects as go
 from tqdm import tqdm
 
+import compression
+import instrument
+import pipeline
 import utils as util
 
 
-def compress_recording(data, window_size=150000, sliding=True, inc=7000):
+def compress_recording(data, window_size=150000, sliding=True, inc=7000,
+        method="gzip"):
     """
     Compresses the raw data from a single recording using a window_size window
     of samples to include in each compression batch. 
@@ -24,23 +30,32 @@ def compress_recording(data, window_size=150000, sliding=True, inc=7000):
     correspond to the compression ratios. For example, for comp_ratios[i], this
     compression sample was started at sample number timestamps[i] and included
     inc samples of data.
+
+    The method argument selects the codec, see compression.register_codec.
+
+    Data may also be a (C, N) multi-channel array, in which case each
+    compression batch contains the window of samples from all channels.
     """
 
     comp_ratios = []
     timestamps = []
+    compress = compression.get_codec(method)
 
-    num_slices = data.shape[0] // window_size
+    num_slices = data.shape[-1] // window_size
 
     if not sliding:
         for i in tqdm(range(num_slices)):
 
             # Snip data slice, convert to bytes
-            data_slice = data[i * window_size: i * window_size + window_size]
-            data_slice = data_slice.astype('float32')
-            data_bytes = data_slice.tobytes()
+            data_slice = data[..., i * window_size: i * window_size + window_size]
+            with instrument.span('convert'):
+                data_slice = data_slice.astype('float32')
+                data_bytes = data_slice.tobytes()
 
             # Compress
-            data_bytes_compressed = gzip.compress(data_bytes)
+            with instrument.span('compress', nbytes=len(data_bytes),
+                    method=method):
+                data_bytes_compressed = compress(data_bytes)
 
             # Get raw size, ratio size
             size_raw = len(data_bytes)
@@ -51,16 +66,19 @@ def compress_recording(data, window_size=150000, sliding=True, inc=7000):
             timestamps.append(i * window_size)
     else:
         start = 0
-        num_slices = data.shape[0] // inc
+        num_slices = data.shape[-1] // inc
 
         for i in tqdm(range(num_slices)):
             # Snip data slice, convert to bytes
-            data_slice = data[start:start + window_size]
-            data_slice = data_slice.astype('float32')
-            data_bytes = data_slice.tobytes()
+            data_slice = data[..., start:start + window_size]
+            with instrument.span('convert'):
+                data_slice = data_slice.astype('float32')
+                data_bytes = data_slice.tobytes()
 
             # Compress
-            data_bytes_compressed = gzip.compress(data_bytes)
+            with instrument.span('compress', nbytes=len(data_bytes),
+                    method=method):
+                data_bytes_compressed = compress(data_bytes)
 
             # Get raw size, ratio size
             size_raw = len(data_bytes)
@@ -74,12 +92,20 @@ def compress_recording(data, window_size=150000, sliding=True, inc=7000):
     
     return comp_ratios, timestamps
 
-def compress_recordings_list(recs, keys):
+def compress_recordings_list(recs, keys, prefetch_depth=1, max_bytes=None):
+    """
+    Compresses every recording in keys with compress_recording.
+
+    For recordings in a store, the data of the next prefetch_depth recordings
+    is read from disk in the background while the current one is compressed,
+    with at most max_bytes of data in memory at once, see pipeline.prefetch.
+    """
 
     results = {}
 
-    for key in keys:
-        data = recs[key]['data']
+    loaded = pipeline.prefetch(keys, partial(_read_data, recs),
+        depth=prefetch_depth, max_bytes=max_bytes)
+    for key, data in loaded:
         cmp_ratios, ts = compress_recording(data)
 
         results[key] = {}
@@ -88,6 +114,12 @@ def compress_recordings_list(recs, keys):
 
     return results
 
+def _read_data(recs, key):
+    with instrument.span('read_data', rec_id=key) as info:
+        data = pipeline.read_into_memory(recs[key]['data'])
+        info['bytes'] = data.nbytes
+    return data
+
 def plot_ratios_key(results, key, events=None, show=True, fig=None,
         line_name=None, sample_rate=30000, start_s=None):
 
@@ -102,6 +134,7 @@ def plot_ratios_key(results, key, events=None, show=True, fig=None,
 
 def plot_ratios(ratios, timestamps, events=None, show=True, fig=None,
         line_name=None, sample_rate=30000):
+    import plotly.graph_objects as go
 
     np_ratios =  np.asarray(ratios)
 
@@ -156,25 +189,29 @@ def plot_ratios(ratios, timestamps, events=None, show=True, fig=None,
     if show: fig.show()
     return fig
 
-def compression_experiment(recs, keys):
+def compression_experiment(recs, keys, method="gzip"):
     """
     Original compression test experiment.
     Compresses data slices corresponding to all specified keys 
     """
 
     compression_results = {}
+    compress = compression.get_codec(method)
 
     min_length = util.get_min_length(recs, keys)
 
     for rec_id in keys:
         for cond in keys[rec_id]:
             data_slice = util.get_condition_slice(recs[rec_id]['cond'], cond,
-                    recs[rec_id]['data'])[:min_length]
+                    recs[rec_id]['data'])[..., :min_length]
 
-            data_slice = data_slice.astype('float32')
+            with instrument.span('convert'):
+                data_slice = data_slice.astype('float32')
+                data_bytes = data_slice.tobytes()
 
-            data_bytes = data_slice.tobytes()
-            data_bytes_compressed = gzip.compress(data_bytes)
+            with instrument.span('compress', nbytes=len(data_bytes),
+                    method=method):
+                data_bytes_compressed = compress(data_bytes)
 
             size_raw = len(data_bytes)
             size_gz = len(data_bytes_compressed)
@@ -190,7 +227,72 @@ def compression_experiment(recs, keys):
 
     return compression_results
 
+def compression_experiment_table(recs, keys, method="gzip", truncate=True,
+        workers=None, max_in_flight=None):
+    """
+    Batched version of compression_experiment. Compresses the data slices of
+    all specified keys in parallel and returns the results as a table instead
+    of printing them.
+
+    Inputs:
+    - recs: recordings dictionary
+    - keys: dictionary of rec_ids -> list of desired conditions
+    - method: compression method, see compression.register_codec
+    - truncate: truncate every slice to the length of the shortest condition,
+            as compression_experiment does. The lengths are computed from the
+            condition indexes, without slicing the data.
+    - workers: number of worker processes. Defaults to cpu_count().
+    - max_in_flight: cap on the number of slices sent to the workers and not
+            done yet, which bounds the memory of the copies sent to them to
+            roughly that many slices. Defaults to workers.
+
+    Returns a pandas DataFrame with one row per (recording, condition) and the
+    columns rec_id, condition, raw (bytes), compressed (bytes), ratio and time
+    (seconds spent compressing).
+    """
+    import pandas as pd
+    if workers is None: workers = cpu_count()
+    if max_in_flight is None: max_in_flight = workers
+
+    items = [(rec_id, c) for rec_id in keys for c in keys[rec_id]]
+    length = None
+    if truncate:
+        length = min(util.get_condition_length(recs[rec_id]['cond'], c,
+            recs[rec_id]['data'].shape[-1]) for rec_id, c in items)
+
+    # Slices are only cut as earlier ones finish, instead of all at once as
+    # executor.map does.
+    args = ((method, util.get_condition_slice(recs[rec_id]['cond'], c,
+        recs[rec_id]['data'])[..., :length]) for rec_id, c in items)
+
+    results = [None] * len(items)
+    with instrument.span('compression_experiment_table', items=len(items)), \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, result in tqdm(pipeline.map_bounded(executor, _compress_timed,
+                args, max_in_flight), total=len(items)):
+            results[i] = result
+
+    table = pd.DataFrame(results, columns=['raw', 'compressed', 'time'])
+    table.insert(0, 'rec_id', [rec_id for rec_id, _ in items])
+    table.insert(1, 'condition', [c for _, c in items])
+    table.insert(4, 'ratio', table['compressed'] / table['raw'])
+
+    return table
+
+def _compress_timed(method, data_slice):
+    with instrument.span('convert'):
+        data_bytes = np.ascontiguousarray(data_slice,
+            dtype=np.float32).tobytes()
+
+    t0 = time.perf_counter()
+    with instrument.span('compress', nbytes=len(data_bytes), method=method):
+        size_comp = len(compression.get_codec(method)(data_bytes))
+    elapsed = time.perf_counter() - t0
+
+    return len(data_bytes), size_comp, elapsed
+
 def plot_compression_results(result):
+    import plotly.graph_objects as go
 
     fig = go.Figure()
     conds = []
@@ -209,9 +311,13 @@ def plot_compression_results(result):
                         yaxis_title='Recording condition')
     fig.show()
 
-def compression_pyramid(data):
+def compression_pyramid(data, single_pass=False):
     """
     Compression experiment of varied size window increments.
+
+    With single_pass, all window sizes are estimated together from one pass of
+    block compression (see compression.get_compression_pyramid), which is
+    much faster but slightly overestimates the ratios.
     """
 
     # inc_vals = [100, 1000, 4000, 7000, 10000, 15000, 20000, 25000]
@@ -219,6 +325,16 @@ def compression_pyramid(data):
     window_vals = [100000, 120000, 150000]
     results = []
 
+    if single_pass:
+        pyramid = compression.get_compression_pyramid(data, window_vals, [7000])
+        for w, ratios, timestamps in zip(pyramid['window_size'],
+                pyramid['ratios'], pyramid['timestamps']):
+            valid = ~np.isnan(ratios)
+            name = "Window size " + str(w)
+            results.append((ratios[valid].tolist(),
+                timestamps[valid].astype(int).tolist(), name))
+        return results
+
     # for v in inc_vals:
     for w in window_vals:
         print("Compressing data with increment value " + str(w))
@@ -231,6 +347,7 @@ def compression_pyramid(data):
 
 def plot_compression_pyramid(results, show=True, events=None,
         use_seconds=False):
+    import plotly.graph_objects as go
 
     fig = go.Figure()
 
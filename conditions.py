@@ -0,0 +1,138 @@
+"""
+Array-backed event condition tables.
+
+Recordings store their event conditions as a dict of
+{'scent 31': {'start': s, 'end': e}, ...}. ConditionTable holds the same
+information as sorted start/end arrays with an interval index, for fast
+range queries and vectorized durations. It also reads like the dict form
+(table['scent 31']['start']), and converts to and from it, so pickled
+recordings objects keep working.
+"""
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class ConditionTable(Mapping):
+    """
+    Event conditions of one or more recordings, sorted by start sample.
+
+    Attributes:
+        labels: (K,) array of condition names
+        starts: (K,) int64 array of start sample indexes, sorted
+        ends: (K,) int64 array of end sample indexes. Conditions without an
+            end (e.g. a scent that was never marked as removed) have
+            end == start and open_ended set.
+        open_ended: (K,) bool array
+        rec_ids: (K,) array of recording ids, or None for a single recording
+    """
+
+    def __init__(self, labels, starts, ends, open_ended=None, rec_ids=None):
+        order = np.argsort(starts, kind='stable')
+        self.labels = np.asarray(labels, dtype=object)[order]
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        if open_ended is None:
+            open_ended = np.zeros(len(order), dtype=bool)
+        self.open_ended = np.asarray(open_ended, dtype=bool)[order]
+        self.rec_ids = None if rec_ids is None else \
+            np.asarray(rec_ids, dtype=object)[order]
+
+        # Running maximum of the ends: every condition before index i ends by
+        # max_end[i], which bounds the search for overlapping conditions even
+        # though conditions may overlap each other.
+        self.max_end = np.maximum.accumulate(self.ends) if len(order) else \
+            self.ends
+        self._index = {(None if rec_ids is None else self.rec_ids[i],
+            self.labels[i]): i for i in range(len(order))}
+
+    @classmethod
+    def from_dict(cls, cond):
+        """
+        Builds a table from the dict form of a recording's conditions.
+        """
+        labels = list(cond.keys())
+        starts = [cond[k]['start'] for k in labels]
+        open_ended = ['end' not in cond[k] for k in labels]
+        ends = [cond[k].get('end', cond[k]['start']) for k in labels]
+        return cls(labels, starts, ends, open_ended)
+
+    @classmethod
+    def from_recordings(cls, recs, rec_ids=None):
+        """
+        Builds a single table of the conditions of several recordings, for
+        batch queries across recordings. rec_ids defaults to all recordings.
+        """
+        if rec_ids is None: rec_ids = list(recs.keys())
+        tables = [as_table(recs[r]['cond']) for r in rec_ids]
+        return cls(
+            np.concatenate([t.labels for t in tables]),
+            np.concatenate([t.starts for t in tables]),
+            np.concatenate([t.ends for t in tables]),
+            np.concatenate([t.open_ended for t in tables]),
+            np.concatenate([[r] * len(t) for r, t in zip(rec_ids, tables)]),
+        )
+
+    def to_dict(self):
+        """
+        Returns the dict form of the conditions, as stored in recordings
+        objects, in order of start sample.
+        """
+        return {label: self[label] for label in self}
+
+    def __getitem__(self, key):
+        i = self._index[(None, key) if self.rec_ids is None else key]
+        item = {'start': int(self.starts[i])}
+        if not self.open_ended[i]:
+            item['end'] = int(self.ends[i])
+        return item
+
+    def __iter__(self):
+        if self.rec_ids is None:
+            return iter(self.labels)
+        return zip(self.rec_ids, self.labels)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def durations(self):
+        """
+        Returns the (K,) array of condition durations in samples.
+        """
+        return self.ends - self.starts
+
+    def overlapping(self, a, b):
+        """
+        Returns the indexes (in start order) of the conditions that overlap
+        the sample range [a, b).
+        """
+        lo = np.searchsorted(self.max_end, a, side='right')
+        hi = np.searchsorted(self.starts, b, side='left')
+        idx = np.arange(lo, hi)
+        return idx[self.ends[lo:hi] > a]
+
+    def at(self, t):
+        """
+        Returns the indexes of the conditions active at sample t, i.e. with
+        start <= t < end.
+        """
+        return self.overlapping(t, t + 1)
+
+    def keys_at(self, idx):
+        """
+        Returns the keys (labels, or (rec_id, label) pairs for a table of
+        several recordings) of the conditions at the indexes idx.
+        """
+        if self.rec_ids is None:
+            return list(self.labels[idx])
+        return list(zip(self.rec_ids[idx], self.labels[idx]))
+
+
+def as_table(cond):
+    """
+    Returns cond as a ConditionTable, converting it from the dict form if
+    needed.
+    """
+    if isinstance(cond, ConditionTable):
+        return cond
+    return ConditionTable.from_dict(cond)
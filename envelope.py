@@ -0,0 +1,145 @@
+"""
+Min/max envelope pyramids for fast plotting of long recordings.
+
+Level 0 of a pyramid holds the minimum and maximum of every BASE_BIN samples,
+and every following level combines LEVEL_FACTOR bins of the level below. To
+draw any time span at a given pixel width, the coarsest level that still has
+at least one bin per pixel is used, so plotting cost depends on the plot
+width and not on the length of the span. Pyramids are saved next to the
+recording's data, e.g. data_obj/oct10/006_envelope.npz for a recordings store.
+"""
+import os
+import weakref
+
+import numpy as np
+
+BASE_BIN = 64
+LEVEL_FACTOR = 4
+CHUNK_SIZE = BASE_BIN * 2**16
+
+# In-memory pyramids of arrays that are not in a store, keyed by id(data).
+_pyramids = {}
+
+
+def build_envelope_pyramid(data, base_bin=BASE_BIN, factor=LEVEL_FACTOR,
+        min_bins=256):
+    """
+    Computes the min/max envelope pyramid of a (N, ) or (C, N) array. Memmaps
+    are read CHUNK_SIZE samples at a time.
+
+    Returns a list of levels, finest first. Each level is a dictionary with
+    'bin' (samples per bin) and (..., N // bin) float32 'min' and 'max' arrays.
+    The last partial bin is included.
+    """
+    n = data.shape[-1]
+    chunk = CHUNK_SIZE - CHUNK_SIZE % base_bin
+    mins = []
+    maxs = []
+    for a in range(0, n, chunk):
+        block = np.asarray(data[..., a:a + chunk], dtype=np.float32)
+        lo, hi = _reduce_bins(block, block, base_bin)
+        mins.append(lo)
+        maxs.append(hi)
+
+    levels = [{'bin': base_bin, 'min': np.concatenate(mins, axis=-1),
+        'max': np.concatenate(maxs, axis=-1)}]
+    while levels[-1]['min'].shape[-1] > min_bins:
+        prev = levels[-1]
+        lo, hi = _reduce_bins(prev['min'], prev['max'], factor)
+        levels.append({'bin': prev['bin'] * factor, 'min': lo, 'max': hi})
+
+    return levels
+
+
+def save_envelope_pyramid(levels, path):
+    arrays = {}
+    for i, level in enumerate(levels):
+        arrays['min_' + str(i)] = level['min']
+        arrays['max_' + str(i)] = level['max']
+        arrays['bin_' + str(i)] = np.asarray(level['bin'])
+    np.savez(path, **arrays)
+
+
+def load_envelope_pyramid(path):
+    """
+    Loads a pyramid saved with save_envelope_pyramid. All levels are read and
+    the file is closed; a pyramid takes about 1/24 of the bytes of float32
+    data.
+    """
+    with np.load(path) as f:
+        num_levels = sum(1 for k in f.files if k.startswith('bin_'))
+        return [{'bin': int(f['bin_' + str(i)]), 'min': f['min_' + str(i)],
+            'max': f['max_' + str(i)]} for i in range(num_levels)]
+
+
+def envelope_path(rec):
+    """
+    Returns the path the pyramid of a recording is saved at, next to its data
+    file, or None if the recording's data is not on disk (e.g. a recording
+    loaded from a pickle).
+    """
+    data_path = getattr(rec, 'data_path', None)
+    if data_path is None:
+        return None
+    return os.path.splitext(data_path)[0] + '_envelope.npz'
+
+
+def get_envelope_pyramid(rec):
+    """
+    Returns the envelope pyramid of a recording. For recordings in a store,
+    the pyramid is built once and saved next to the data, then loaded from
+    there. For other recordings it is kept in memory for as long as the data
+    array exists.
+    """
+    path = envelope_path(rec)
+    if path is None:
+        data = rec['data']
+        if id(data) not in _pyramids:
+            _pyramids[id(data)] = build_envelope_pyramid(data)
+            weakref.finalize(data, _pyramids.pop, id(data), None)
+        return _pyramids[id(data)]
+
+    if not os.path.exists(path) or \
+            os.path.getmtime(path) < os.path.getmtime(rec.data_path):
+        save_envelope_pyramid(build_envelope_pyramid(rec['data']), path)
+    return load_envelope_pyramid(path)
+
+
+def get_span(data, levels, start=0, end=None, width_px=2000):
+    """
+    Returns what is needed to draw data[..., start:end] at width_px pixels:
+    (x, y_min, y_max), where x are sample indexes. Spans of at most
+    2 * width_px samples are returned as raw samples, (x, y, None). Spans too
+    short for any level of the pyramid are binned from the raw samples
+    instead, so at most about 2 * width_px points are drawn per channel.
+    """
+    n = data.shape[-1]
+    if end is None: end = n
+    if end - start <= 2 * width_px:
+        return np.arange(start, end), np.asarray(data[..., start:end]), None
+
+    level = None
+    for lvl in levels:
+        if (end - start) // lvl['bin'] >= width_px:
+            level = lvl
+    if level is None:
+        # Fewer than BASE_BIN * width_px samples, cheap to bin here.
+        b = (end - start) // width_px
+        block = np.asarray(data[..., start:end], dtype=np.float32)
+        lo, hi = _reduce_bins(block, block, b)
+        return start + np.arange(lo.shape[-1]) * b, lo, hi
+
+    b = level['bin']
+    first = start // b
+    last = -(-end // b)
+    x = np.arange(first, last) * b
+    return x, level['min'][..., first:last], level['max'][..., first:last]
+
+
+def _reduce_bins(lo, hi, size):
+    # Min of lo and max of hi over every size consecutive samples along the
+    # last axis, including a partial last bin.
+    idx = np.arange(0, lo.shape[-1], size)
+    return np.minimum.reduceat(lo, idx, axis=-1), \
+        np.maximum.reduceat(hi, idx, axis=-1)
+
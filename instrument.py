@@ -0,0 +1,256 @@
+"""
+Opt-in timing and memory instrumentation of the pipeline stages.
+
+Stages are wrapped in spans:
+
+    with instrument.span('compress', nbytes=len(data_bytes)):
+        ...
+
+Spans do nothing unless tracing is enabled, either with enable() or by
+setting the EOG_TRACE environment variable to a directory before starting
+python. Every process (including pool workers, which inherit the setting)
+then appends one JSON line per span to <dir>/trace-<pid>.jsonl, with the wall
+time, CPU time, bytes processed and peak RSS during the span. export_trace
+merges these files into a Chrome trace that can be opened in
+chrome://tracing or https://ui.perfetto.dev, and summary totals them per
+stage.
+"""
+from contextlib import contextmanager
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+TRACE_ENV = 'EOG_TRACE'
+
+# Open trace file of this process, reopened after a fork.
+_out = {'pid': None, 'file': None}
+_lock = threading.Lock()
+
+# Peak RSS so far of every open span of this process, see _begin_peak_rss.
+_open_peaks = []
+
+
+def enable(trace_dir='trace'):
+    """
+    Enables tracing to trace_dir for this process and any worker processes
+    started from now on.
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_ENV] = os.path.abspath(trace_dir)
+
+
+def disable():
+    os.environ.pop(TRACE_ENV, None)
+    if _out['file'] is not None:
+        _out['file'].close()
+    _out['pid'] = _out['file'] = None
+
+
+def enabled():
+    return bool(os.environ.get(TRACE_ENV))
+
+
+@contextmanager
+def span(name, nbytes=None, **args):
+    """
+    Records the duration of the enclosed block as stage name. nbytes is the
+    number of bytes the stage processed; any other keyword arguments are
+    stored with the span as well.
+
+    Yields a dictionary of these arguments, so values that are only known at
+    the end of the block can be added, e.g. info['bytes'] = data.nbytes.
+
+    On Linux, the span records the peak RSS of the process while it ran
+    ('peak_rss') and how far that is above the RSS at its start
+    ('rss_growth'), in bytes. Memory of other threads running at the same
+    time counts too. Elsewhere only the peak RSS of the process since it
+    started is known, which is recorded as 'process_max_rss'.
+    """
+    info = dict(args)
+    if nbytes is not None:
+        info['bytes'] = nbytes
+    if not os.environ.get(TRACE_ENV):
+        yield info
+        return
+
+    peak = _begin_peak_rss()
+    c0 = time.process_time()
+    t0 = time.time()
+    try:
+        yield info
+    finally:
+        t1 = time.time()
+        event = {
+            'name': name,
+            'ts': t0,
+            'wall': t1 - t0,
+            'cpu': time.process_time() - c0,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        if 'bytes' in info:
+            event['bytes'] = int(info.pop('bytes'))
+        if peak is not None:
+            _end_peak_rss(peak)
+            event['peak_rss'] = peak['peak']
+            event['rss_growth'] = peak['peak'] - peak['rss0']
+        elif max_rss() is not None:
+            event['process_max_rss'] = max_rss()
+        if info:
+            event['args'] = info
+        _write(event)
+
+
+def read_events(trace_dir=None):
+    """
+    Returns all spans recorded in trace_dir (by default the enabled one),
+    sorted by start time.
+    """
+    if trace_dir is None: trace_dir = os.environ[TRACE_ENV]
+
+    events = []
+    for path in glob.glob(os.path.join(trace_dir, 'trace-*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                # A worker may have been killed halfway through a line.
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+
+    events.sort(key=lambda e: e['ts'])
+    return events
+
+
+def export_trace(out_path, trace_dir=None):
+    """
+    Writes the spans recorded in trace_dir as a Chrome trace event JSON file,
+    with one row per process and thread.
+    """
+    trace = []
+    for e in read_events(trace_dir):
+        args = dict(e.get('args', {}))
+        args['cpu_s'] = e['cpu']
+        for key in ('bytes', 'peak_rss', 'rss_growth', 'process_max_rss'):
+            if key in e: args[key] = e[key]
+        trace.append({
+            'name': e['name'],
+            'ph': 'X',
+            'ts': e['ts'] * 1e6,
+            'dur': e['wall'] * 1e6,
+            'pid': e['pid'],
+            'tid': e['tid'],
+            'args': args,
+        })
+
+    with open(out_path, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary(trace_dir=None):
+    """
+    Totals the spans recorded in trace_dir per stage.
+
+    Returns a dictionary of stage name -> dictionary with the number of spans
+    ('count'), total 'wall' and 'cpu' seconds, total 'bytes', the number of
+    processes the stage ran in ('pids'), the highest peak RSS in bytes of any
+    of its spans ('peak_rss') and the largest RSS growth during one of them
+    ('rss_growth'). These are None where they could not be measured per span
+    (see span).
+    """
+    stages = {}
+    for e in read_events(trace_dir):
+        s = stages.setdefault(e['name'], {'count': 0, 'wall': 0., 'cpu': 0.,
+            'bytes': 0, 'pids': set(), 'peak_rss': None, 'rss_growth': None})
+        s['count'] += 1
+        s['wall'] += e['wall']
+        s['cpu'] += e['cpu']
+        s['bytes'] += e.get('bytes', 0)
+        s['pids'].add(e['pid'])
+        for key in ('peak_rss', 'rss_growth'):
+            if key in e:
+                s[key] = max(s[key] or 0, e[key])
+
+    for s in stages.values():
+        s['pids'] = len(s['pids'])
+    return stages
+
+
+def max_rss(children=False):
+    """
+    Returns the peak resident set size of this process since it started, or
+    with children=True that of its largest terminated child process, in
+    bytes. Returns None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _begin_peak_rss():
+    # Resets the kernel's peak RSS of the process, so that it covers only the
+    # new span. The peaks reached by the spans that are already open are
+    # saved first. Returns None where this is not supported (not Linux).
+    with _lock:
+        status = _rss_status()
+        if status is None:
+            return None
+        for p in _open_peaks:
+            p['peak'] = max(p['peak'], status['VmHWM'])
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            return None
+        peak = {'peak': status['VmRSS'], 'rss0': status['VmRSS']}
+        _open_peaks.append(peak)
+        return peak
+
+
+def _end_peak_rss(peak):
+    with _lock:
+        status = _rss_status()
+        for p in _open_peaks:
+            p['peak'] = max(p['peak'], status['VmHWM'])
+        _open_peaks.remove(peak)
+
+
+def _rss_status():
+    # Current (VmRSS) and peak (VmHWM) RSS in bytes from /proc, or None.
+    try:
+        with open('/proc/self/status') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    status = {}
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key in ('VmRSS', 'VmHWM'):
+            status[key] = int(value.split()[0]) * 1024
+    return status if len(status) == 2 else None
+
+
+def _write(event):
+    with _lock:
+        if _out['pid'] != os.getpid():
+            # First span of this process, or a forked worker that inherited
+            # the parent's file.
+            trace_dir = os.environ[TRACE_ENV]
+            os.makedirs(trace_dir, exist_ok=True)
+            _out['file'] = open(os.path.join(trace_dir,
+                'trace-' + str(os.getpid()) + '.jsonl'), 'a')
+            _out['pid'] = os.getpid()
+        _out['file'].write(json.dumps(event) + '\n')
+        # Workers are not always shut down cleanly, so don't buffer spans.
+        _out['file'].flush()
@@ -1,3 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import cpu_count
 import os
 from tqdm import tqdm
 import pickle
@@ -6,39 +9,62 @@ import pdb
 import numpy as np
 import scipy.io as sio
 
+import blackrock
+import cache
+import instrument
+import pipeline
+import store
 import utils as util
 
 DATA_DIR = "blackrock_data/2021-10-11/mat_files"
+RAW_DATA_DIR = "blackrock_data/2021-10-11/raw"
 COND_DIR = "blackrock_data/2021-10-11/conditions"
 COMMENT_DIR = "blackrock_data/2021-10-11/comment_csv"
+# Comments of all recordings written by utils.export_comments_table, without
+# the extension (see utils.TABLE_EXTENSIONS). If it exists, it is used instead
+# of the per-recording csv files.
+COMMENT_TABLE = os.path.join(COMMENT_DIR, "comments")
 
 FILEBASE = "datafile"
 
 DATA_OBJ_DIR = "data_obj/"
 
 
-def save_recordings_object(recs, filename):
+def save_recordings_object(recs, filename, as_store=False):
     """
     Saves the recordings object recs to the specified filename in the
     DATA_OBJ_DIR path.
+    With as_store=True, it is written as a recordings store directory instead
+    of a pickle (see store.py), which load_recordings_object opens lazily.
     """
     outpath = os.path.join(DATA_OBJ_DIR, filename)
-    pickle.dump(recs, open(outpath, 'wb'))
+    if as_store:
+        store.save_store(recs, outpath)
+    else:
+        pickle.dump(recs, open(outpath, 'wb'))
     print("Saved recordings object to file at", outpath)
 
 def load_recordings_object(filename):
     """
     Loads the recordings object from the specified filename in the
-    DATA_OBJ_DIR path, and returns it
+    DATA_OBJ_DIR path, and returns it.
+    If filename is a recordings store directory, the recordings are returned
+    as memory-mapped LazyRecording objects and no sample data is read until
+    it is sliced.
     """
     path = os.path.join(DATA_OBJ_DIR, filename)
-    recs = pickle.load(open(path, 'rb'))
+    if store.is_store(path):
+        return store.open_store(path)
+
+    with instrument.span('load_recordings_object', path=path):
+        recs = pickle.load(open(path, 'rb'))
 
     return recs
 
 ### Raw data extraction functions below ###
 
-def load_recording(rec_id, create_csv_only=False):
+def load_recording(rec_id, create_csv_only=False, use_cache=True, channels=0,
+        start=None, end=None):
     """
     Loads the raw data from blackrock NEV and NS6 files saved to .mat files. The
     x_NEV.mat and x_NS6.mat files are read to extract the raw recording data and
@@ -47,57 +73,264 @@ def load_recording(rec_id, create_csv_only=False):
     strings, such as "scent 20" map to another dictionary with 'start' and 'end'
     keys, which each map to the raw data timestamp associated with it.
 
+    With use_cache, the result is stored in the local cache (see cache.py) and
+    returned from there until any of the source files change.
+
+    By default only the first channel is returned as a (N, ) array. Pass a list
+    of channel indexes, or None for all channels, to get a contiguous (C, N)
+    array instead.
+
+    start and end sample indexes select a range of samples, of which only
+    these are read from -v7.3 files (see utils.get_data). The conditions are
+    still sample indexes into the whole recording. See also
+    load_condition_slice.
+
     Returns raw data numpy array and dict of event conditions.
     """
 
     NEV_FILENAME = FILEBASE + rec_id + "_NEV.mat"
     NSX_FILENAME = FILEBASE + rec_id + "_NS6.mat"
 
-    # Read NEV, NSX
     nev_path = os.path.join(DATA_DIR, NEV_FILENAME)
     nsx_path = os.path.join(DATA_DIR, NSX_FILENAME)
-    nev = sio.loadmat(nev_path)
-    nsx = sio.loadmat(nsx_path)
-    data = util.get_data(nsx) # make data available
 
-    # Read Comments from csv
-    comment_filename = FILEBASE + NEV_FILENAME[-11:-8] + "_comments.csv"
-    comment_path = os.path.join(COMMENT_DIR, comment_filename)
+    comment_path = _comment_csv_path(rec_id)
+    cond_path = os.path.join(util.COND_DIR, rec_id + ".pkl")
 
     if not os.path.exists(COMMENT_DIR):
         os.makedirs(COMMENT_DIR)
 
     if create_csv_only:
-        comments = util.get_comments(nev)
+        with instrument.span('read_nev_comments', path=nev_path):
+            comments = util.read_nev_comments(nev_path)
         util.save_comments_to_csv(comments, comment_path)
         return None, None
 
-    comments = util.load_comments_from_csv(comment_path)
+    table_paths = comment_table_paths()
+    if use_cache:
+        key = cache.cache_key(
+            [nsx_path, comment_path] + table_paths + [cond_path],
+            extra=[channels, start, end])
+        with instrument.span('cache_get'):
+            cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    # Read NSX
+    nsx = util.load_nsx(nsx_path)
+    # make data available
+    data = util.get_data(nsx, start=start, end=end, channels=channels)
+    if hasattr(nsx, 'close'): nsx.close()
+
+    cond = load_conditions(rec_id)
+
+    if use_cache:
+        with instrument.span('cache_put', nbytes=data.nbytes):
+            cache.put(key, data, cond)
 
-    cond_file = rec_id + ".pkl"
-    cond = util.load_conditions_from_file(cond_file)
+    return data, cond
+
+def load_conditions(rec_id):
+    """
+    Returns the event conditions of a recording, from its conditions file in
+    utils.COND_DIR if there is one, or else found in its comments (from the
+    comments table or csv), without reading any samples.
+    """
+    # Read Comments from the comments table, or csv
+    table_path = next((p for p in comment_table_paths() if os.path.exists(p)),
+        None)
+    if table_path is not None:
+        with instrument.span('load_comments', path=table_path):
+            comments = util.load_comments_table(table_path, rec_id)
+    else:
+        comments = util.load_comments_from_csv(_comment_csv_path(rec_id))
+
+    cond = util.load_conditions_from_file(rec_id + ".pkl")
 
     # If there is no conditions file saved, then auto generate the conditions 
     # from the comments
     if cond is None:
         # pdb.set_trace()
-        cond = util.find_condition_endpoints(comments)
+        with instrument.span('find_conditions'):
+            cond = util.find_condition_endpoints(comments)
+
+    return cond
+
+def load_condition_slice(rec_id, key, channels=0, use_cache=False):
+    """
+    Returns the samples of recording rec_id during condition key, like
+    utils.get_condition_slice, while only reading those samples from -v7.3
+    files. Slices are not cached by default, since reading them is cheap.
+    """
+    cond = load_conditions(rec_id)
+    data, _ = load_recording(rec_id, use_cache=use_cache, channels=channels,
+        start=cond[key]['start'], end=cond[key]['end'])
+
+    return data
+
+def _comment_csv_path(rec_id):
+    return os.path.join(COMMENT_DIR, FILEBASE + rec_id + "_comments.csv")
+
+def comment_table_paths():
+    """
+    Returns the paths COMMENT_TABLE may have been exported to, in the order
+    they are looked for. If COMMENT_TABLE has an extension, only that path.
+    """
+    if os.path.splitext(COMMENT_TABLE)[1]:
+        return [COMMENT_TABLE]
+    return [COMMENT_TABLE + ext for ext in util.TABLE_EXTENSIONS]
+
+def load_channel_info(rec_id, channels=None):
+    """
+    Returns the channel metadata (index, electrode id and label, see
+    utils.get_channel_info) of a recording. This is cheap for -v7.3 NS6 files,
+    where only the ElectrodesInfo struct is read.
+    """
+    nsx_path = os.path.join(DATA_DIR, FILEBASE + rec_id + "_NS6.mat")
+    nsx = util.load_nsx(nsx_path)
+    info = util.get_channel_info(nsx, channels=channels)
+    if hasattr(nsx, 'close'): nsx.close()
+
+    return info
+
+def load_recording_object(rec_id, channels=0, use_cache=True, start=None,
+        end=None):
+    """
+    Loads a single recording as a recordings object entry, i.e. a dictionary
+    with the 'data' and 'cond' keys. For multi-channel data (channels is a
+    list or None), 'data' is a (C, N) array and the entry also has a
+    'channels' key with the metadata of each row. See load_recording for
+    start and end.
+    """
+    data, cond = load_recording(rec_id, use_cache=use_cache, channels=channels,
+        start=start, end=end)
+    rec = {'data': data, 'cond': cond}
+    if channels is None or np.ndim(channels) > 0:
+        rec['channels'] = load_channel_info(rec_id, channels)
+
+    return rec
+
+def load_recording_raw(rec_id, uv=False, channels=0):
+    """
+    Loads a recording straight from the raw blackrock .nev and .ns6 files in
+    RAW_DATA_DIR, without the MATLAB preproc.m step.
+
+    By default the returned data is a zero-copy int16 view into the
+    memory-mapped .ns6 file, in digital units (see the channel 'scale' and
+    'offset' from blackrock.read_nsx_header), so this returns immediately
+    regardless of recording length. With uv=True it is
+    converted to uV like openNSx('uv'), which reads the whole recording into
+    a float64 array. Pass None as channels to get all channels as a (C, N)
+    array. For recordings that were paused, only the samples and conditions
+    of the first segment are returned.
+
+    Returns raw data numpy array and dict of event conditions.
+    """
+    nev_path = os.path.join(RAW_DATA_DIR, FILEBASE + rec_id + ".nev")
+    nsx_path = os.path.join(RAW_DATA_DIR, FILEBASE + rec_id + ".ns6")
+
+    with instrument.span('get_nsx_data', path=nsx_path) as info:
+        nsx = blackrock.open_nsx(nsx_path)
+        data = blackrock.get_nsx_data(nsx, channels, uv=uv)
+        info['bytes'] = data.nbytes
+
+    cond = util.load_conditions_from_file(rec_id + ".pkl")
+    if cond is None:
+        with instrument.span('read_nev_comments', path=nev_path):
+            comments = blackrock.read_nev_comments(nev_path, nsx)
+        # Comments made during other segments fall outside of data.
+        keep = (comments['end'] >= 0) & (comments['end'] < data.shape[-1])
+        comments = {k: v[keep] for k, v in comments.items()}
+        with instrument.span('find_conditions'):
+            cond = util.find_condition_endpoints(comments)
 
     return data, cond
 
 # REC_IDS = ['001', '003', '006', '007', '009', '011', '012', '013']
 REC_IDS = ['001', '002', '003', '004', '005', '006']
 
-def load_all_recordings(create_csv_only=False):
+def iter_recordings(rec_ids=None, workers=None, max_in_flight=None,
+        channels=0):
+    """
+    Loads recordings in a pool of worker processes and yields
+    (rec_id, recording) tuples as each recording finishes, in completion
+    order. Each recording is a dictionary as returned by
+    load_recording_object.
+
+    Inputs:
+    - rec_ids: list of recording ids to load. Defaults to REC_IDS.
+    - workers: number of worker processes. Defaults to cpu_count().
+    - max_in_flight: cap on the number of recordings being loaded or waiting
+            to be consumed at once, which bounds peak memory to roughly that
+            many recordings. Defaults to workers.
+    - channels: channels to load, see load_recording.
+    """
+    if rec_ids is None: rec_ids = REC_IDS
+    if workers is None: workers = cpu_count()
+    if max_in_flight is None: max_in_flight = workers
+
+    rec_ids = list(rec_ids)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        args = ((rec_id, channels) for rec_id in rec_ids)
+        for i, rec in pipeline.map_bounded(executor, load_recording_object,
+                args, max_in_flight):
+            yield rec_ids[i], rec
+
+def prefetch_recordings(rec_ids=None, depth=1, max_bytes=None, channels=0):
+    """
+    Loads recordings one after the other and yields (rec_id, recording)
+    tuples in order, while the next depth recordings are loaded in a
+    background thread (see pipeline.prefetch). Use this to process recordings
+    one at a time in this process, e.g. to compress each one, with loading
+    overlapped with the processing. Unlike iter_recordings, the data is not
+    copied between processes.
+
+    Inputs:
+    - rec_ids: list of recording ids to load. Defaults to REC_IDS.
+    - depth: number of recordings loaded ahead
+    - max_bytes: cap on the total size of the loaded recordings that have not
+            been processed yet, including the current one
+    - channels: channels to load, see load_recording.
+
+    Data returned from the cache is memory-mapped; it is read into memory in
+    the background thread, so cached recordings are prefetched too and count
+    against max_bytes.
+    """
+    if rec_ids is None: rec_ids = REC_IDS
+    load = partial(_load_recording_into_memory, channels=channels)
+    return pipeline.prefetch(rec_ids, load, depth=depth, max_bytes=max_bytes)
+
+def _load_recording_into_memory(rec_id, channels=0):
+    rec = load_recording_object(rec_id, channels=channels)
+    rec['data'] = pipeline.read_into_memory(rec['data'])
+    return rec
+
+def load_all_recordings(create_csv_only=False, workers=1, max_in_flight=None,
+        channels=0):
     """
     Reads all recordings (raw data and conditions dictionary) and returns it as
     a dictionary structure with the recording ids as keys.
+
+    With workers > 1 (or None for one per cpu), recordings are loaded in
+    parallel worker processes, see iter_recordings. See load_recording for
+    the channels argument.
     """
+    if create_csv_only:
+        for rec_id in tqdm(REC_IDS):
+            load_recording(rec_id, create_csv_only)
+        return {}
+
     print('Loading all recordings...')
     recordings = {}
-    for rec_id in tqdm(REC_IDS):
-        data, cond = load_recording(rec_id, create_csv_only)
-        if create_csv_only: continue
-        recordings[rec_id] = {'data': data, 'cond': cond}
 
-    return recordings
+    if workers == 1:
+        results = ((rec_id, load_recording_object(rec_id, channels))
+            for rec_id in REC_IDS)
+    else:
+        results = iter_recordings(REC_IDS, workers, max_in_flight, channels)
+
+    for rec_id, rec in tqdm(results, total=len(REC_IDS)):
+        recordings[rec_id] = rec
+
+    # Keep the REC_IDS order regardless of completion order.
+    return {rec_id: recordings[rec_id] for rec_id in REC_IDS}
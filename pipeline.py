@@ -0,0 +1,159 @@
+"""
+Prefetching of recordings in a background thread, and bounded submission of
+work to process pools.
+
+Reading a recording (sio.loadmat, pickle, or the pages of a memmap) mostly
+waits on the disk, while compressing or transforming it mostly waits on the
+CPU. prefetch loads the next items in a background thread while the caller
+works on the current one, so a run over many recordings takes about as long
+as the slower of the two instead of their sum:
+
+    for rec_id, rec in pipeline.prefetch(rec_ids, loader.load_recording_object):
+        compress(rec['data'])
+
+The number of items loaded ahead is bounded by depth, and their total size by
+max_bytes.
+
+map_bounded plays the same role for process pools: work is submitted only as
+earlier work finishes, so the arguments and results waiting in the pool stay
+bounded.
+"""
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, wait
+import threading
+
+import numpy as np
+
+
+def prefetch(items, load, depth=1, max_bytes=None, size=None):
+    """
+    Yields (item, load(item)) for every item, in order, while the following
+    items are loaded in a background thread.
+
+    Inputs:
+    - items: iterable of items to load, e.g. recording ids
+    - load: function loading one item. It runs in a thread, so it should
+            spend its time in I/O or in code that releases the GIL (numpy,
+            zlib, file reads), as loaders do.
+    - depth: maximum number of loaded items waiting to be consumed
+    - max_bytes: memory budget. No new item is loaded while the loaded items,
+            including the one being consumed, take max_bytes or more. The
+            first item is always loaded, so an item larger than the budget
+            is simply not overlapped with anything.
+    - size: function returning the size in bytes of a loaded item, see
+            nbytes (the default)
+
+    Exceptions raised by load are raised here when their item is reached.
+    An item counts as consumed when the next one is requested, so its result
+    should not be kept past that point if max_bytes is to hold.
+    """
+    if size is None: size = nbytes
+    ready = deque()
+    cond = threading.Condition()
+    state = {'held': 0, 'done': False, 'stop': False, 'error': None}
+
+    def can_load():
+        return state['stop'] or (len(ready) < depth and
+            (max_bytes is None or state['held'] < max_bytes))
+
+    def worker():
+        try:
+            for item in items:
+                with cond:
+                    cond.wait_for(can_load)
+                    if state['stop']: return
+                result = load(item)
+                n = size(result)
+                with cond:
+                    ready.append((item, result, n))
+                    state['held'] += n
+                    cond.notify_all()
+        except BaseException as e:
+            with cond:
+                state['error'] = e
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    consumed = 0
+    try:
+        while True:
+            with cond:
+                # The previous item is done with, release its budget.
+                state['held'] -= consumed
+                consumed = 0
+                cond.notify_all()
+                cond.wait_for(lambda: ready or state['done'])
+                if ready:
+                    item, result, consumed = ready.popleft()
+                    cond.notify_all()
+                elif state['error'] is not None:
+                    raise state['error']
+                else:
+                    return
+            yield item, result
+    finally:
+        # Stops the thread after its current load if the caller stops early.
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+
+
+def map_bounded(executor, func, args, max_in_flight):
+    """
+    Calls func(*a) in executor for every tuple a in args and yields
+    (index, result) tuples in completion order, where index is the position of
+    a in args.
+
+    args is consumed lazily and at most max_in_flight calls are submitted and
+    not yet yielded at any time, unlike executor.map, which submits every call
+    up front. Use this when the arguments or results are large, e.g. slices
+    of recordings, or when they are expensive to create.
+    """
+    args = iter(enumerate(args))
+    in_flight = {}
+    exhausted = False
+    while not exhausted or in_flight:
+        while not exhausted and len(in_flight) < max_in_flight:
+            try:
+                i, a = next(args)
+            except StopIteration:
+                exhausted = True
+                break
+            in_flight[executor.submit(func, *a)] = i
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield in_flight.pop(future), future.result()
+
+
+def nbytes(obj):
+    """
+    Returns the total size of the numpy arrays in obj, which may be an array
+    or a (nested) tuple, list or dictionary of them, like a recording. Memmaps
+    count as 0 since they are not read into memory.
+    """
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(o) for o in obj)
+    if isinstance(obj, Mapping):
+        return sum(nbytes(o) for o in obj.values())
+    return 0
+
+
+def read_into_memory(data):
+    """
+    Returns data as an in-memory array. Memmaps (e.g. data from a recordings
+    store) are read in full, other arrays are returned as they are.
+    """
+    if isinstance(data, np.memmap):
+        return np.array(data)
+    return data
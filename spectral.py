@@ -0,0 +1,279 @@
+"""
+Spectral analysis of recordings, separate from plotting.
+
+The functions here stack many data slices (e.g. all conditions of a
+recording) into one 2-D batch and compute their spectra with a single batched
+FFT or Welch PSD call, instead of one full-length FFT per slice.
+"""
+import os
+
+import numpy as np
+from scipy import signal
+from scipy.fft import next_fast_len, rfft, rfftfreq
+
+import filters
+
+SAMPLE_RATE = 30000 # samples / s
+
+
+def stack_slices(slices, length=None):
+    """
+    Stacks a list of (N, ) or (C, N) slices into a single (K, N) or (K, C, N)
+    array, truncating every slice to length samples (by default the length of
+    the shortest slice).
+    """
+    if length is None:
+        length = min(s.shape[-1] for s in slices)
+
+    batch = np.empty((len(slices),) + slices[0].shape[:-1] + (length,))
+    for i, s in enumerate(slices):
+        batch[i] = s[..., :length]
+
+    return batch
+
+
+def batch_fft(slices, fs=SAMPLE_RATE, fast_len=True, max_freq=None):
+    """
+    Computes the magnitude spectrum of every slice with one batched rfft. All
+    slices are truncated to the length of the shortest one, like
+    utils.plot_fft does.
+
+    Inputs:
+    - slices: list of (N, ) or (C, N) arrays
+    - fs: sample rate in samples per second
+    - fast_len: zero-pad to the next FFT size that factors into small primes,
+            which can be many times faster than an awkward length
+    - max_freq: only return frequencies up to max_freq Hz
+
+    Returns frequencies (F, ) and magnitudes (K, F) or (K, C, F).
+    """
+    batch = stack_slices(slices)
+    n = batch.shape[-1]
+    if fast_len:
+        n = next_fast_len(n, real=True)
+
+    freq = rfftfreq(n, 1 / fs)
+    power = np.abs(rfft(batch, n=n, axis=-1, workers=-1))
+
+    return _crop(freq, power, max_freq)
+
+
+def batch_psd(slices, fs=SAMPLE_RATE, nperseg=None, noverlap=None,
+        max_freq=None):
+    """
+    Computes the Welch power spectral density of every slice in one batched
+    call. Averaging over segments of nperseg samples gives a much smoother
+    estimate than a single full-length FFT, at a resolution of fs / nperseg Hz
+    that is far closer to what EOG analysis needs.
+
+    Inputs:
+    - slices: list of (N, ) or (C, N) arrays, truncated to the shortest one
+    - fs: sample rate in samples per second
+    - nperseg: samples per segment, at most the slice length. Segments are
+            zero-padded to a fast FFT size. Defaults to 4 seconds of data
+            (0.25 Hz resolution).
+    - noverlap: samples of overlap between segments. Defaults to nperseg // 2.
+    - max_freq: only return frequencies up to max_freq Hz
+
+    Returns frequencies (F, ) and PSD (K, F) or (K, C, F).
+    """
+    batch = stack_slices(slices)
+    if nperseg is None:
+        nperseg = 4 * fs
+    nperseg = min(nperseg, batch.shape[-1])
+
+    freq, psd = signal.welch(batch, fs=fs, nperseg=nperseg, noverlap=noverlap,
+        nfft=next_fast_len(nperseg, real=True), axis=-1)
+
+    return _crop(freq, psd, max_freq)
+
+
+def condition_spectra(cond, data, keys=None, method='psd', **kwargs):
+    """
+    Computes the spectrum of every condition specified in keys (all
+    conditions in cond if None) of a recording.
+
+    method is 'psd' (see batch_psd) or 'fft' (see batch_fft); kwargs are
+    passed on to it.
+
+    Returns frequencies, spectra (one row per key) and the list of keys.
+    """
+    key_set = list(cond.keys()) if keys is None else list(keys)
+    slices = [data[..., cond[k]['start']:cond[k]['end']] for k in key_set]
+
+    freq, power = _spectrum_func(method)(slices, **kwargs)
+    return freq, power, key_set
+
+
+def recordings_condition_spectra(recordings, keys, method='psd', **kwargs):
+    """
+    Computes the spectrum of conditions across recordings in one batch.
+
+    Inputs:
+    - recordings: dictionary of all recordings
+    - keys: dict of rec_id -> list of conditions of that recording
+
+    Returns frequencies, spectra (one row per condition) and labels of the
+    form "<rec_id>: <condition>".
+    """
+    slices = []
+    labels = []
+    for rec_id in keys:
+        rec = recordings[rec_id]
+        for c in keys[rec_id]:
+            slices.append(rec['data'][..., rec['cond'][c]['start']:
+                rec['cond'][c]['end']])
+            labels.append(rec_id + ': ' + c)
+
+    freq, power = _spectrum_func(method)(slices, **kwargs)
+    return freq, power, labels
+
+
+def compute_spectrogram(data, fs=SAMPLE_RATE, nperseg=None, noverlap=None,
+        decimate=1, max_freq=None, chunk_size=3000000, out_path=None,
+        n_samples=None):
+    """
+    Computes the spectrogram of a long (N, ) recording chunk by chunk, with
+    memory bounded by chunk_size samples plus one segment.
+
+    Inputs:
+    - data: (N, ) array, memmap or h5py dataset that is read chunk_size samples
+            at a time, or an iterable of consecutive chunks of samples
+    - fs: sample rate in samples per second
+    - nperseg: samples per STFT segment after decimation. Defaults to 1 second.
+    - noverlap: samples of overlap between segments. Defaults to nperseg // 2.
+    - decimate: integer factor by which the data is low-pass filtered and
+            downsampled before the STFT. At 30 kHz, EOG content is far below
+            the Nyquist frequency, so decimating first makes everything
+            faster.
+    - max_freq: only keep frequencies up to max_freq Hz
+    - out_path: if given, Sxx is written to this .npy file as it is computed
+            (with the time and frequency axes in a <out_path>_axes.npz file
+            next to it) and returned as a read-only memmap, see
+            load_spectrogram. Requires the number of samples to be known, i.e.
+            data is an array or n_samples is given.
+
+    Returns Sxx (F, T), t (T, ) in seconds and f (F, ) in Hz, as expected by
+    viz.spec_plot.
+    """
+    fs_out = fs / decimate
+    if nperseg is None:
+        nperseg = int(fs_out)
+    if noverlap is None:
+        noverlap = nperseg // 2
+    hop = nperseg - noverlap
+
+    if hasattr(data, 'shape'):
+        n_samples = data.shape[0]
+        chunks = (data[a:a + chunk_size] for a in range(0, n_samples, chunk_size))
+    else:
+        chunks = data
+
+    f = rfftfreq(nperseg, 1 / fs_out)
+    keep = f <= max_freq if max_freq is not None else slice(None)
+    f = f[keep]
+
+    n_segments = None
+    if n_samples is not None:
+        n_out = -(-n_samples // decimate)
+        n_segments = max((n_out - nperseg) // hop + 1, 0)
+
+    if out_path is not None:
+        if n_segments is None:
+            raise ValueError("n_samples is required to write to out_path")
+        # Fortran order keeps every block of time columns contiguous on disk.
+        Sxx = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32,
+            shape=(f.shape[0], n_segments), fortran_order=True)
+    else:
+        columns = []
+
+    decimator = StreamingDecimator(decimate, fs) if decimate > 1 else None
+    buf = np.empty(0)
+    seg_done = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if decimator is not None:
+            chunk = decimator.process(chunk)
+        buf = np.concatenate([buf, chunk])
+
+        k = (buf.shape[0] - nperseg) // hop + 1 if buf.shape[0] >= nperseg else 0
+        if n_segments is not None:
+            k = min(k, n_segments - seg_done)
+        if k <= 0:
+            continue
+
+        _, _, block = signal.spectrogram(buf[:(k - 1) * hop + nperseg],
+            fs=fs_out, nperseg=nperseg, noverlap=noverlap)
+        if out_path is not None:
+            Sxx[:, seg_done:seg_done + k] = block[keep]
+        else:
+            columns.append(block[keep].astype(np.float32))
+        seg_done += k
+        buf = buf[k * hop:]
+
+    t = (np.arange(seg_done) * hop + nperseg / 2) / fs_out
+
+    if out_path is None:
+        Sxx = np.concatenate(columns, axis=1) if columns else \
+            np.empty((f.shape[0], 0), dtype=np.float32)
+        return Sxx, t, f
+
+    Sxx.flush()
+    del Sxx
+    np.savez(_axes_path(out_path), t=t, f=f)
+    return load_spectrogram(out_path)
+
+
+def load_spectrogram(path):
+    """
+    Opens a spectrogram written by compute_spectrogram. Sxx is returned as a
+    read-only memmap, so only the time ranges that are used get read.
+
+    Returns Sxx (F, T), t (T, ) and f (F, ).
+    """
+    Sxx = np.load(path, mmap_mode='r')
+    axes = np.load(_axes_path(path))
+    return Sxx, axes['t'], axes['f']
+
+
+class StreamingDecimator:
+    """
+    Low-pass filters and downsamples a signal by an integer factor, one chunk
+    at a time. The filter state is carried over between chunks, so the output
+    is the same as filtering the whole signal at once.
+    """
+
+    def __init__(self, factor, fs=SAMPLE_RATE, order=8):
+        self.factor = factor
+        # Same anti-aliasing filter as scipy.signal.decimate's IIR default.
+        self.filter = filters.StreamingFilter(
+            signal.cheby1(order, 0.05, 0.8 / factor, output='sos'))
+        self.offset = 0
+
+    def process(self, chunk):
+        filtered = self.filter.process(chunk)
+
+        # Keep every factor-th sample of the whole stream, wherever the chunk
+        # boundaries fall.
+        first = (-self.offset) % self.factor
+        self.offset += chunk.shape[0]
+        return filtered[..., first::self.factor]
+
+
+def _axes_path(path):
+    return os.path.splitext(path)[0] + '_axes.npz'
+
+
+def _spectrum_func(method):
+    if method == 'psd':
+        return batch_psd
+    if method == 'fft':
+        return batch_fft
+    raise ValueError("Unsupported spectrum method: " + method)
+
+
+def _crop(freq, power, max_freq):
+    if max_freq is None:
+        return freq, power
+    keep = freq <= max_freq
+    return freq[keep], power[..., keep]
@@ -0,0 +1,118 @@
+"""
+On-disk recordings store.
+
+A store is a directory holding one .npy file of raw samples per recording and
+a small meta.json file with the event conditions and sample rate of every
+recording:
+
+    data_obj/oct10/
+        meta.json
+        001.npy
+        006.npy
+        ...
+
+Opening a store only reads meta.json. Each recording's samples are
+memory-mapped the first time its 'data' key is accessed, so slicing a single
+condition only reads the pages that the slice touches.
+"""
+from collections.abc import MutableMapping
+import json
+import os
+
+import numpy as np
+
+META_FILENAME = "meta.json"
+DEFAULT_SAMPLE_RATE = 30000
+
+
+class LazyRecording(MutableMapping):
+    """
+    A single recording from a store. Behaves like the {'data': ndarray,
+    'cond': dict} dictionaries in pickled recordings objects, except that
+    'data' is a read-only np.memmap that is only opened when first accessed.
+    """
+
+    def __init__(self, data_path, items):
+        self.data_path = data_path
+        self._items = dict(items)
+
+    def __getitem__(self, key):
+        if key == 'data' and 'data' not in self._items:
+            self._items['data'] = np.load(self.data_path, mmap_mode='r')
+        return self._items[key]
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __iter__(self):
+        keys = list(self._items)
+        if 'data' not in self._items:
+            keys.insert(0, 'data')
+        return iter(keys)
+
+    def __len__(self):
+        return len(self._items) + ('data' not in self._items)
+
+    def __repr__(self):
+        return "LazyRecording(" + repr(self.data_path) + ")"
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, META_FILENAME))
+
+
+def save_store(recs, path, sample_rate=DEFAULT_SAMPLE_RATE):
+    """
+    Writes the recordings object recs to a store directory at path. Every
+    recording's 'data' goes to its own .npy file; 'cond' and any other
+    per-recording keys go to meta.json.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    meta = {'sample_rate': sample_rate, 'recordings': {}}
+    for rec_id, rec in recs.items():
+        data_filename = rec_id + ".npy"
+        np.save(os.path.join(path, data_filename), np.asarray(rec['data']))
+
+        entry = {k: v for k, v in rec.items() if k != 'data'}
+        entry['file'] = data_filename
+        meta['recordings'][rec_id] = entry
+
+    # Write the metadata last, so an interrupted save never looks complete.
+    with open(os.path.join(path, META_FILENAME), 'w') as f:
+        json.dump(meta, f, indent=1, default=to_json)
+
+
+def open_store(path):
+    """
+    Opens the store at path and returns a dict of rec_id -> LazyRecording.
+    No sample data is read until it is sliced.
+    """
+    with open(os.path.join(path, META_FILENAME)) as f:
+        meta = json.load(f)
+
+    recs = {}
+    for rec_id, entry in meta['recordings'].items():
+        entry = dict(entry)
+        data_path = os.path.join(path, entry.pop('file'))
+        entry.setdefault('sample_rate', meta['sample_rate'])
+        recs[rec_id] = LazyRecording(data_path, entry)
+
+    return recs
+
+
+def to_json(value):
+    """
+    json.dump default for the numpy values in recordings metadata and
+    conditions. Condition timestamps usually come out of loadmat as numpy
+    integers.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Cannot store value of type " + type(value).__name__)
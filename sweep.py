@@ -0,0 +1,182 @@
+"""
+Resumable command-line runner for compression sweeps.
+
+Computes sliding window compression ratios (as
+compression_experiment.compress_recording does) for every combination of
+recording, window size, increment and codec, in parallel across cores:
+
+    python sweep.py data_obj/oct10 --recs 001 006 --window 100000 150000 \\
+        --inc 7000 --codec gzip zlib:6 --out sweeps/oct10
+
+Every finished (recording, window, inc, codec) unit is saved to its own file
+in <out>/units/, so an interrupted sweep picks up where it stopped when it is
+run again with the same output directory. When all units are done, they are
+assembled into one table with the columns rec_id, window, inc, codec,
+timestamp and ratio, written to <out>/results.parquet (or .npz without
+pyarrow, see --table).
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import os
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+import compression
+import store
+import utils as util
+
+UNIT_DIR = 'units'
+
+# Stores opened by this worker process, keyed by path.
+_stores = {}
+
+
+def unit_name(rec_id, window, inc, codec):
+    return '{}_w{}_i{}_{}'.format(rec_id, window, inc, codec.replace(':', '-'))
+
+
+def unit_path(out_dir, unit):
+    return os.path.join(out_dir, UNIT_DIR, unit_name(*unit) + '.npz')
+
+
+def plan_units(rec_ids, windows, incs, codecs):
+    """
+    Returns the list of (rec_id, window, inc, codec) units of a sweep.
+    """
+    return list(itertools.product(rec_ids, windows, incs, codecs))
+
+
+def pending_units(units, out_dir):
+    """
+    Returns the units that have no checkpoint in out_dir yet.
+    """
+    return [u for u in units if not os.path.exists(unit_path(out_dir, u))]
+
+
+def run_unit(store_path, unit, out_dir):
+    """
+    Computes the compression ratios of one unit and saves them to its
+    checkpoint file. Runs in a worker process; the recording is read from the
+    memory-mapped store, so only the path is sent to the worker.
+    """
+    rec_id, window, inc, codec = unit
+    if store_path not in _stores:
+        _stores[store_path] = store.open_store(store_path)
+    data = _stores[store_path][rec_id]['data']
+
+    # Same windows as compress_recording with sliding=True.
+    num_slices = data.shape[-1] // inc
+    starts = np.arange(num_slices) * inc
+    ratios = np.array([compression.get_compression_ratio_for_slice(codec,
+        np.asarray(data[..., s:s + window], dtype=np.float32)) for s in starts])
+
+    # Write to a temporary file first, so an interrupted unit is never
+    # mistaken for a finished one.
+    path = unit_path(out_dir, unit)
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, ratio=ratios, timestamp=starts + window)
+    os.replace(tmp, path)
+
+    return unit
+
+
+def run_sweep(store_path, units, out_dir, workers=None):
+    """
+    Runs every unit that has no checkpoint yet in a pool of worker processes.
+
+    Returns the list of units that failed, after printing their errors. Units
+    that finished are kept even if others fail.
+    """
+    os.makedirs(os.path.join(out_dir, UNIT_DIR), exist_ok=True)
+    todo = pending_units(units, out_dir)
+    print('{} of {} units done, {} to run'.format(len(units) - len(todo),
+        len(units), len(todo)))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_unit, store_path, u, out_dir): u
+            for u in todo}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                print('Unit', unit_name(*futures[future]), 'failed:', repr(e))
+                failed.append(futures[future])
+
+    return failed
+
+
+def collect_results(units, out_dir):
+    """
+    Reads the checkpoints of units into one table of columns: rec_id, window,
+    inc, codec, timestamp and ratio, with one row per compression window.
+    """
+    columns = {k: [] for k in ('rec_id', 'window', 'inc', 'codec',
+        'timestamp', 'ratio')}
+    for unit in units:
+        f = np.load(unit_path(out_dir, unit))
+        n = f['ratio'].shape[0]
+        for key, value in zip(('rec_id', 'window', 'inc', 'codec'), unit):
+            columns[key].append(np.full(n, value))
+        columns['timestamp'].append(f['timestamp'])
+        columns['ratio'].append(f['ratio'])
+
+    return {k: np.concatenate(v) for k, v in columns.items()}
+
+
+def default_table_path(out_dir):
+    try:
+        import pyarrow
+        return os.path.join(out_dir, 'results.parquet')
+    except ImportError:
+        return os.path.join(out_dir, 'results.npz')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store', help='recordings store directory')
+    parser.add_argument('--recs', nargs='+',
+        help='recording ids (default: all recordings in the store)')
+    parser.add_argument('--window', type=int, nargs='+', default=[150000],
+        help='window sizes in samples')
+    parser.add_argument('--inc', type=int, nargs='+', default=[7000],
+        help='window increments in samples')
+    parser.add_argument('--codec', nargs='+', default=['gzip'],
+        help='codecs, "name" or "name:level", see compression.register_codec')
+    parser.add_argument('--workers', type=int,
+        help='worker processes (default: one per cpu)')
+    parser.add_argument('--out', required=True,
+        help='output directory, reused to resume a sweep')
+    parser.add_argument('--table', help='results table path (default: '
+        '<out>/results.parquet, or results.npz without pyarrow)')
+    args = parser.parse_args(argv)
+
+    if not store.is_store(args.store):
+        parser.error(args.store + ' is not a recordings store')
+    try:
+        # Fail before starting any work on unknown codecs.
+        for codec in args.codec: compression.get_codec(codec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    rec_ids = args.recs or list(store.open_store(args.store).keys())
+    units = plan_units(rec_ids, args.window, args.inc, args.codec)
+
+    failed = run_sweep(args.store, units, args.out, args.workers)
+    if failed:
+        print(len(failed), 'units failed; run again to retry them.')
+        return 1
+
+    table_path = args.table or default_table_path(args.out)
+    util.save_table(collect_results(units, args.out), table_path)
+    print('Saved results to', table_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
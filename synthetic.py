@@ -0,0 +1,172 @@
+"""
+Synthetic EOG recordings for benchmarks and tests without the private data.
+
+generate_recording produces a 30 kHz recording with slow drift, eye movement
+bursts during annotated scent conditions, blinks, line noise and sensor noise,
+along with the comments and conditions that the real pipeline would extract.
+The write_* functions save it in the formats the loaders read.
+"""
+import os
+
+import numpy as np
+import scipy.io as sio
+
+import blackrock
+import utils as util
+
+SAMPLE_RATE = 30000 # samples / s
+
+
+def generate_recording(duration_s=60, n_channels=1, fs=SAMPLE_RATE,
+        n_conditions=6, line_freq=60, seed=0, dtype=np.float32):
+    """
+    Generates a synthetic EOG recording.
+
+    Inputs:
+    - duration_s: length of the recording in seconds
+    - n_channels: number of channels. Every channel sees the same eye signal
+            with its own gain, plus independent noise.
+    - n_conditions: number of annotated scent conditions, evenly spread over
+            the recording
+    - line_freq: power line frequency in Hz
+
+    Returns a dictionary with:
+        - 'data': (N, ) array for a single channel, or (C, N) array of uV
+        - 'cond': conditions dictionary, as find_condition_endpoints returns
+        - 'comments': 'text', 'start' and 'end' comment arrays, as
+          get_comments returns
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration_s * fs)
+    t = np.arange(n) / fs
+
+    # Slow electrode drift: heavily smoothed random walk.
+    drift = np.cumsum(rng.standard_normal(n // fs + 2)) * 20
+    eye = np.interp(t, np.arange(drift.shape[0]), drift)
+
+    # Annotated conditions with 0.5 - 1 Hz eye movements.
+    comments = {'text': [], 'start': [], 'end': []}
+    period = n // max(n_conditions, 1)
+    for i in range(n_conditions):
+        start = i * period + period // 4
+        end = start + period // 2
+        freq = rng.uniform(0.5, 1.0)
+        eye[start:end] += 80 * np.sin(2 * np.pi * freq * t[start:end])
+
+        for text, ts in (('Scent ' + str(i + 1), start), ('Removed', end)):
+            comments['text'].append(text)
+            # Comments are started half a second before they are entered,
+            # but not before the recording.
+            comments['start'].append(max(ts - fs // 2, 0))
+            comments['end'].append(ts)
+
+    # Blinks: ~200 ms pulses about every 4 seconds.
+    blink = np.hanning(int(0.2 * fs)) * 250
+    for b in rng.integers(0, n - blink.shape[0], max(int(duration_s / 4), 1)):
+        eye[b:b + blink.shape[0]] += blink
+
+    line = 15 * np.sin(2 * np.pi * line_freq * t) + \
+        4 * np.sin(2 * np.pi * 3 * line_freq * t)
+
+    data = np.empty((n_channels, n), dtype=dtype)
+    for c in range(n_channels):
+        gain = rng.uniform(0.5, 1.5)
+        data[c] = gain * eye + line + rng.standard_normal(n) * 5
+
+    comments = {k: np.asarray(v) for k, v in comments.items()}
+    return {
+        'data': data[0] if n_channels == 1 else data,
+        'cond': util.find_condition_endpoints(comments),
+        'comments': comments,
+    }
+
+
+def write_mat_files(rec, rec_id, data_dir, comment_dir,
+        filebase='datafile'):
+    """
+    Writes a synthetic recording like preproc.m and the comment export would,
+    so that loader.load_recording can read it with DATA_DIR = data_dir and
+    COMMENT_DIR = comment_dir.
+    """
+    for d in (data_dir, comment_dir):
+        if not os.path.exists(d): os.makedirs(d)
+
+    data = np.atleast_2d(rec['data']).astype(np.float64)
+    # 1 x C struct array, as openNSx creates it.
+    electrodes = np.zeros((1, data.shape[0]), dtype=[('ElectrodeID', 'O'),
+        ('Label', 'O')])
+    for c in range(data.shape[0]):
+        electrodes[0, c] = (c + 1, 'elec' + str(c + 1))
+    sio.savemat(os.path.join(data_dir, filebase + rec_id + '_NS6.mat'),
+        {'NS6': {'Data': data, 'ElectrodesInfo': electrodes}})
+    sio.savemat(os.path.join(data_dir, filebase + rec_id + '_NEV.mat'),
+        {'NEV': {'Data': {'Comments': {
+            'Text': rec['comments']['text'],
+            'TimeStampStarted': rec['comments']['start'],
+            'TimeStamp': rec['comments']['end'],
+        }}}})
+    util.save_comments_to_csv(rec['comments'], os.path.join(comment_dir,
+        filebase + rec_id + '_comments.csv'))
+
+
+def write_blackrock_files(rec, rec_id, raw_dir, filebase='datafile',
+        fs=SAMPLE_RATE):
+    """
+    Writes a synthetic recording as raw .ns6 and .nev files (file spec 2.3),
+    so that loader.load_recording_raw can read it with RAW_DATA_DIR = raw_dir.
+    Samples are stored as int16 at 0.25 uV per bit, like the real recordings.
+    """
+    if not os.path.exists(raw_dir): os.makedirs(raw_dir)
+
+    data = np.atleast_2d(rec['data'])
+    n_chan = data.shape[0]
+
+    basic = np.zeros(1, dtype=blackrock.NSX_BASIC_HEADER)
+    basic['file_type_id'] = b'NEURALCD'
+    basic['file_spec'] = (2, 3)
+    basic['bytes_in_headers'] = blackrock.NSX_BASIC_HEADER.itemsize + \
+        n_chan * blackrock.NSX_EXT_HEADER.itemsize
+    basic['period'] = 30000 // fs
+    basic['time_resolution'] = 30000
+    basic['channel_count'] = n_chan
+
+    ext = np.zeros(n_chan, dtype=blackrock.NSX_EXT_HEADER)
+    ext['type'] = b'CC'
+    ext['electrode_id'] = np.arange(1, n_chan + 1)
+    ext['label'] = [('elec' + str(c + 1)).encode() for c in range(n_chan)]
+    ext['min_digital'] = -32764
+    ext['max_digital'] = 32764
+    ext['min_analog'] = -8191
+    ext['max_analog'] = 8191
+    ext['units'] = b'uV'
+
+    samples = np.clip(np.round(data * 4), -32764, 32764).astype('<i2')
+    with open(os.path.join(raw_dir, filebase + rec_id + '.ns6'), 'wb') as f:
+        f.write(basic.tobytes())
+        f.write(ext.tobytes())
+        f.write(b'\x01')
+        f.write(np.array([0, data.shape[1]], dtype='<u4').tobytes())
+        # Write in blocks to keep memory bounded for long recordings.
+        for a in range(0, data.shape[1], 2**20):
+            f.write(np.ascontiguousarray(samples[:, a:a + 2**20].T).tobytes())
+
+    packet_size = 104
+    nev = np.zeros(1, dtype=blackrock.NEV_BASIC_HEADER)
+    nev['file_type_id'] = b'NEURALEV'
+    nev['file_spec'] = (2, 3)
+    nev['bytes_in_headers'] = blackrock.NEV_BASIC_HEADER.itemsize
+    nev['bytes_in_data_packets'] = packet_size
+    nev['time_resolution_timestamps'] = 30000
+    nev['time_resolution_samples'] = 30000
+
+    packets = np.zeros(len(rec['comments']['text']), dtype=[
+        ('timestamp', '<u4'), ('packet_id', '<u2'), ('char_set', 'u1'),
+        ('flag', 'u1'), ('data', '<u4'), ('text', 'S' + str(packet_size - 12)),
+    ])
+    packets['timestamp'] = rec['comments']['end']
+    packets['packet_id'] = blackrock.NEV_COMMENT_PACKET_ID
+    packets['data'] = rec['comments']['start']
+    packets['text'] = [t.encode() for t in rec['comments']['text']]
+    with open(os.path.join(raw_dir, filebase + rec_id + '.nev'), 'wb') as f:
+        f.write(nev.tobytes())
+        f.write(packets.tobytes())
@@ -2,14 +2,19 @@ import glob
 import os
 import pickle
 import pdb
+import re
 
 import numpy as np
 import scipy.io as sio
-import plotly.graph_objects as go
-import matplotlib.pyplot as plt
-import pandas as pd
+
+import conditions
+import instrument
 
 BLACKROCK_DATA_DIR = 'blackrock_data'
+COND_DIR = 'blackrock_data/conditions'
+# Table formats read and written by save_table and load_comments_table, in the
+# order they are looked for.
+TABLE_EXTENSIONS = ('.parquet', '.feather', '.npz')
 
 def get_comments(nev):
     """
@@ -28,16 +33,109 @@ def get_comments(nev):
 
     return comments
 
-def get_data(nsx, mode='NS6'):
+def is_mat_v73(path):
+    """
+    Returns True if the .mat file at path was saved with -v7.3, i.e. it is an
+    HDF5 file that scipy.io.loadmat cannot read.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(128)
+    return header.startswith(b'MATLAB 7.3')
+
+def load_nsx(path):
+    """
+    Opens an NSx .mat file. Files saved with -v7.3 (as preproc.m does) are
+    opened as an h5py.File without reading any samples; older files are read
+    with scipy.io.loadmat. Either result can be passed to get_data.
+    """
+    with instrument.span('load_nsx', path=path):
+        if is_mat_v73(path):
+            import h5py
+            return h5py.File(path, 'r')
+
+        return sio.loadmat(path)
+
+def get_data(nsx, mode='NS6', start=None, end=None, channels=0,
+        chunk_size=1000000):
     """
     Extracts the raw EOG data from the NSx object. 
-    Returns a (N, ) array of data.
+    Returns a (N, ) array of data for a single channel, or a contiguous
+    (C, N) array if channels is a list of channel indexes or None (all
+    channels).
+
+    Optionally, start and end sample indexes select a range of samples. For
+    NSx objects opened from -v7.3 files (see load_nsx), only the requested
+    samples and channels are read from disk, chunk_size samples at a time.
+    """
+    if not hasattr(nsx, 'id'):
+        # scipy.io.loadmat object, everything is already in memory.
+        data = nsx[mode]['Data'][0][0]
+        if channels is None: channels = slice(None)
+        with instrument.span('get_data') as info:
+            out = np.ascontiguousarray(data[channels, start:end])
+            info['bytes'] = out.nbytes
+        return out
+
+    # MATLAB stores matrices column-major, so the HDF5 dataset of the
+    # (channels x samples) Data matrix has shape (samples, channels).
+    dset = nsx[mode]['Data']
+    n = dset.shape[0]
+    start, end, _ = slice(start, end).indices(n)
+    if channels is None: channels = list(range(dset.shape[1]))
+    chan_idx = np.atleast_1d(channels)
+    order = np.argsort(chan_idx)
+
+    out = np.empty((chan_idx.shape[0], max(end - start, 0)), dtype=dset.dtype)
+    with instrument.span('get_data', nbytes=out.nbytes):
+        for a in range(start, end, chunk_size):
+            b = min(a + chunk_size, end)
+            # h5py needs increasing channel indexes for point selection
+            block = dset[a:b, np.sort(chan_idx)] if chan_idx.shape[0] > 1 \
+                else dset[a:b, int(chan_idx[0])][:, None]
+            out[order, a - start:b - start] = block.T
+
+    if np.ndim(channels) == 0:
+        return out[0]
+    return out
+
+def get_channel_info(nsx, mode='NS6', channels=None):
     """
-    data = nsx[mode]['Data'][0][0][0]
-    return data
+    Returns a list with a metadata dictionary for each of the requested
+    channels (all channels if None), in the same order as the rows returned by
+    get_data:
+        - 'index': row of the channel in the NSx Data matrix
+        - 'id': electrode id
+        - 'label': electrode label
+    """
+    if not hasattr(nsx, 'id'):
+        n_chan = nsx[mode]['Data'][0][0].shape[0]
+        info = nsx[mode]['ElectrodesInfo'][0][0].ravel()
+        ids = [int(np.ravel(e)[0]) for e in info['ElectrodeID']]
+        labels = [str(np.ravel(l)[0]).strip() if np.size(l) else ''
+            for l in info['Label']]
+    else:
+        n_chan = nsx[mode]['Data'].shape[1]
+        info = nsx[mode]['ElectrodesInfo']
+        ids = [int(np.ravel(e)[0]) for e in _h5_struct_field(nsx, info,
+            'ElectrodeID')]
+        labels = [''.join(map(chr, np.ravel(l))).strip()
+            for l in _h5_struct_field(nsx, info, 'Label')]
+
+    if channels is None: channels = range(n_chan)
+    return [{'index': int(i), 'id': ids[i], 'label': labels[i]}
+        for i in np.atleast_1d(channels)]
+
+def _h5_struct_field(f, group, name):
+    # Fields of MATLAB struct arrays in -v7.3 files are stored as arrays of
+    # references, one per struct element.
+    dset = group[name]
+    if dset.dtype.kind == 'O':
+        return [f[ref][()] for ref in dset[()].ravel()]
+    return [dset[()]]
 
 def plot_data(data, label=None, xlabel='sample # (sample rate: 30kHz)',
         ylabel='uV', freq=None):
+    import matplotlib.pyplot as plt
     # fig = go.Figure()
     # fig.add_trace(go.Scatter(x=np.arange(data.shape[1]), y=data,
                     # mode='lines'))
@@ -46,9 +144,10 @@ def plot_data(data, label=None, xlabel='sample # (sample rate: 30kHz)',
     if freq is not None:
         x = freq
     else:
-        x = np.arange(data.shape[0])
+        x = np.arange(data.shape[-1])
 
-    plt.plot(x, data, label=label, alpha=0.75)
+    # (C, N) data plots one line per channel
+    plt.plot(x, data.T, label=label, alpha=0.75)
     plt.legend()
 
     plt.xlabel(xlabel)
@@ -56,20 +155,24 @@ def plot_data(data, label=None, xlabel='sample # (sample rate: 30kHz)',
 
 def plot_data_plotly(data, fig, label=None, xlabel='sample # (sample rate: 30kHz)',
         ylabel='uV', freq=None):
+    import plotly.graph_objects as go
 
     if freq is not None:
         x = freq
     else:
-        x = np.arange(data.shape[0])
+        x = np.arange(data.shape[-1])
 
     # fig = go.Figure()
-    fig.add_trace(go.Scatter(x=x, y=data,
-                    mode='lines', name=label))
+    for i, channel_data in enumerate(np.atleast_2d(data)):
+        name = label if data.ndim == 1 else str(label) + ' ch' + str(i)
+        fig.add_trace(go.Scatter(x=x, y=channel_data,
+                        mode='lines', name=name))
     fig.update_layout(xaxis_title=xlabel, yaxis_title=ylabel)
     # fig.show()
 
 
 def save_comments_to_csv(comments, pathname):
+    import pandas as pd
     df = pd.DataFrame(comments)
     df.to_csv(pathname, index=False)
 
@@ -78,55 +181,208 @@ def process_all_nev_to_csv(data_dir='blackrock_data/mat_files'):
 
     for f in files:
         num = f[-11:-8]
-        nev = sio.loadmat(f)
-        comments = get_comments(nev)
+        comments = read_nev_comments(f)
 
         comment_path = "OE_recording_Blackrock" + num + "_comments.csv"
         save_comments_to_csv(comments, comment_path)
 
+def read_nev_comments(path):
+    """
+    Reads only the comments of a NEV file, without the rest of the NEV
+    struct where possible:
+        - raw .nev files: only the comment packets are read, see blackrock.py
+        - -v7.3 .mat files: only the NEV.Data.Comments group is read
+        - older .mat files: the NEV struct has to be loaded as a whole
+    Returns the same dictionary as get_comments.
+    """
+    if path.endswith('.nev'):
+        import blackrock
+        return blackrock.read_nev_comments(path)
+
+    if not is_mat_v73(path):
+        return get_comments(sio.loadmat(path, variable_names=['NEV']))
+
+    import h5py
+    with h5py.File(path, 'r') as f:
+        group = f['NEV']['Data']['Comments']
+        # MATLAB stores the (N x L) char matrix column-major as (L, N) uint16.
+        chars = group['Text'][()].T
+        text = np.array([''.join(map(chr, row)) for row in chars])
+        return {
+            'text': text,
+            'start': group['TimeStampStarted'][()].ravel(),
+            'end': group['TimeStamp'][()].ravel(),
+        }
+
+def export_comments_table(paths, out_path, workers=None):
+    """
+    Reads the comments of many NEV files (.nev or _NEV.mat) in parallel and
+    writes them to a single table at out_path, with the columns rec_id, text,
+    start and end. The recording id is the 3 digit number in each file name,
+    e.g. '006' for datafile006_NEV.mat. Files without one are skipped.
+
+    The format follows the extension of out_path: .parquet or .feather (these
+    need pyarrow), or .npz otherwise.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    rec_ids = []
+    found = []
+    for p in paths:
+        digits = re.findall(r'\d{3}', os.path.basename(p))
+        if digits:
+            rec_ids.append(digits[-1])
+            found.append(p)
+        else:
+            print('Skipping', p, '(no 3 digit recording id in its name)')
+    paths = found
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        all_comments = list(executor.map(read_nev_comments, paths))
+
+    table = {
+        'rec_id': np.concatenate([[r] * len(c['text'])
+            for r, c in zip(rec_ids, all_comments)]).astype(str),
+        'text': np.concatenate([np.asarray(c['text'], dtype=str)
+            for c in all_comments]),
+        'start': np.concatenate([c['start'] for c in all_comments]).astype(
+            np.int64),
+        'end': np.concatenate([c['end'] for c in all_comments]).astype(
+            np.int64),
+    }
+
+    save_table(table, out_path)
+
+def save_table(table, path):
+    """
+    Writes a dictionary of equal length column arrays as a table. The format
+    follows the extension of path: .parquet or .feather (these need pyarrow),
+    or .npz otherwise.
+    """
+    import pandas as pd
+
+    if path.endswith('.parquet'):
+        pd.DataFrame(table).to_parquet(path, index=False)
+    elif path.endswith('.feather'):
+        pd.DataFrame(table).to_feather(path)
+    else:
+        np.savez(path, **table)
+
+def load_comments_table(path, rec_id):
+    """
+    Returns the comments of recording rec_id from a table written by
+    export_comments_table, as the same dictionary as get_comments.
+    """
+    import pandas as pd
+    if path.endswith('.parquet'):
+        # Only the row groups of this recording are read.
+        df = pd.read_parquet(path, filters=[('rec_id', '==', rec_id)])
+        return {c: df[c].to_numpy() for c in ['text', 'start', 'end']}
+    if path.endswith('.feather'):
+        df = pd.read_feather(path)
+        df = df[df['rec_id'] == rec_id]
+        return {c: df[c].to_numpy() for c in ['text', 'start', 'end']}
+
+    table = np.load(path)
+    mask = table['rec_id'] == rec_id
+    return {c: table[c][mask] for c in ['text', 'start', 'end']}
+
 def load_comments_from_csv(path):
-    df = pd.read_csv(path)
-    comments = df.to_dict('list')
+    """
+    Reads a comments csv saved by save_comments_to_csv. Returns the same
+    dictionary of 'text', 'start' and 'end' arrays as get_comments.
+    """
+    import pandas as pd
+    with instrument.span('load_comments', path=path):
+        df = pd.read_csv(path)
+        comments = {c: df[c].to_numpy() for c in df.columns}
 
     return comments
 
-def find_condition_endpoints(comments):
+def find_condition_endpoints(comments, removed_timestamp='end'):
+    """
+    Finds the event conditions described by the comments of a recording.
+
+    Every comment containing "scent" starts a new condition, named after the
+    lowercased comment text. Repeated names get ' i' appended until they are
+    unique ('scent 1', 'scent 1 i', 'scent 1 i i', ...). The end time of the
+    scent comment indicates the time at which the smell was presented. A
+    following comment containing "removed" ends the most recent condition.
+
+    Inputs:
+    - comments: dictionary of 'text', 'start' and 'end' arrays, see
+            get_comments
+    - removed_timestamp: which timestamp of the 'Removed' comment marks the
+            time at which the smell was removed. This differs by recording:
+            August 08 recording: the start time ('start').
+            October 10 recording: the end time ('end').
+
+    Returns a dictionary of condition name -> {'start': s, 'end': e}.
+    """
+    import pandas as pd
+    text = pd.Series(comments['text'], dtype=str).str.strip().str.lower()
+    start = np.asarray(comments['start'])
+    end = np.asarray(comments['end'])
+    removed_ts = start if removed_timestamp == 'start' else end
+
+    is_scent = text.str.contains('scent', regex=False).to_numpy()
+    is_removed = ~is_scent & text.str.contains('removed', regex=False).to_numpy()
+    scent_idx = np.flatnonzero(is_scent)
+    if scent_idx.shape[0] == 0:
+        return {}
+
+    names = text[is_scent]
+    repeats = names.groupby(names).cumcount().tolist()
+    names = [n + ' i' * k for n, k in zip(names.tolist(), repeats)]
+    if len(set(names)) < len(names):
+        # A comment text itself ends in ' i' and collides with a generated
+        # name; fall back to assigning names one by one.
+        names = []
+        for t in text[is_scent]:
+            while t in names:
+                t = t + ' i'
+            names.append(t)
 
     conditions = {}
-    prev_key = ''
-    for i, _ in enumerate(comments['text']):
-        text = comments['text'][i]
-        start = comments['start'][i]
-        end = comments['end'][i]
-        text_l = text.lower().strip()
-
-        # This indicates the start of a new scent condition
-        if 'scent' in text_l:
-            # The end time for the scent comment indicates the time at which the
-            # smell was presented
-            while text_l in conditions.keys():
-                text_l = text_l + ' i'
-
-            # The end time for the scent comment indicates the time at which the
-            # smell was presented
-            conditions[text_l] = {}
-            conditions[text_l]['start'] = end
-            prev_key = text_l
-
-        # This indicates the point in which the scent stimuli was removed
-        elif 'removed' in text_l:
-            # August 08 recording: The start time for the 'Removed' comment indicates the time at
-            # which the smell was removed.
-            # October 10 recording: The end time for the 'Removed' comment indicates the time at
-            # which the smell was removed.
-            conditions[prev_key]['end'] = end
+    for name, i in zip(names, scent_idx):
+        conditions[name] = {'start': int(end[i])}
+
+    # Each 'removed' comment belongs to the last scent comment before it. If
+    # there are several, the last one wins.
+    removed_idx = np.flatnonzero(is_removed)
+    owner = np.searchsorted(scent_idx, removed_idx) - 1
+    valid = owner >= 0
+    last_removed = pd.Series(removed_ts[removed_idx[valid]]).groupby(
+        owner[valid]).last()
+    for o, ts in last_removed.items():
+        conditions[names[o]]['end'] = int(ts)
 
     return conditions
 
+def find_condition_endpoints_batch(paths, removed_timestamp='end',
+        workers=None):
+    """
+    Extracts the conditions of many comments csv files in parallel.
+
+    Returns a dictionary of path -> conditions dictionary.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(partial(_conditions_from_csv,
+            removed_timestamp=removed_timestamp), paths,
+            chunksize=max(1, len(paths) // 64))
+        return dict(zip(paths, results))
+
+def _conditions_from_csv(path, removed_timestamp='end'):
+    return find_condition_endpoints(load_comments_from_csv(path),
+        removed_timestamp)
+
 def save_conditions_to_file(cond, path):
     pickle.dump(cond, open(path, 'wb'))
 
-def load_conditions_from_file(filename, cond_dir='blackrock_data/conditions'):
+def load_conditions_from_file(filename, cond_dir=COND_DIR):
     outpath = os.path.join(cond_dir, filename)
     if not os.path.exists(outpath): return None
 
@@ -134,33 +390,134 @@ def load_conditions_from_file(filename, cond_dir='blackrock_data/conditions'):
     return cond
 
 def get_condition_slice(cond, key, data):
-    slice_data = data[cond[key]['start']:cond[key]['end']]
+    """
+    Returns the samples of data during the condition key. Data may be a (N, )
+    array or a (C, N) multi-channel array, which is sliced along time.
+    """
+    slice_data = data[..., cond[key]['start']:cond[key]['end']]
     return slice_data
 
 def get_slice(data, start, end):
-    slice_data = data[start:end]
+    slice_data = data[..., start:end]
     return slice_data
 
-def plot_fft(data_samples, labels=None, use_plotly=None):
-
-    # Truncate everything to the size of the smallest sample
-    size = data_samples[0].shape[0]
-    for ds in data_samples:
-        s = ds.shape[0]
-        if s < size:
-            size = s
-
-    freq = np.fft.rfftfreq(size) * 30000
-    for i, ds in enumerate(data_samples):
-        fft = np.fft.rfft(ds[:size])
-        fft = np.abs(fft)
-        label = None if labels is None else labels[i]
-        if use_plotly is not None:
-            plot_data_plotly(fft, fig=use_plotly, label=label, freq=freq, xlabel='Frequency',
-                ylabel='Power')
-        else:
-            plot_data(fft, label=label, freq=freq, xlabel='Frequency',
-                ylabel='Power')
+def channel_correlation(data, block_size=None):
+    """
+    Returns the (C, C) matrix of Pearson correlation coefficients between all
+    channels of a (C, N) array, equivalent to np.corrcoef(data) and to the
+    nested corrcoef loop in matlab/xcoor.m.
+
+    With block_size, the data is read block_size samples at a time and only
+    running sums are kept, so long (e.g. memory-mapped) windows never need to
+    be in memory at once.
+    """
+    return _correlation_from_sums(*_correlation_sums(data, block_size))
+
+def condition_correlations(cond, data, keys=None, block_size=None):
+    """
+    Computes the channel correlation matrix for every condition specified in
+    keys (all conditions in cond if None) of a (C, N) recording.
+
+    With block_size, the recording is streamed once in blocks of block_size
+    samples and the sums for every condition overlapping a block are updated
+    from it, so memory is bounded by one block regardless of condition lengths.
+
+    Returns a dictionary of condition key -> (C, C) correlation matrix.
+    """
+    key_set = list(cond.keys()) if keys is None else list(keys)
+
+    if block_size is None:
+        return {key: channel_correlation(get_condition_slice(cond, key, data))
+            for key in key_set}
+
+    n_chan, n = data.shape
+    bounds = {key: (max(cond[key]['start'], 0), min(cond[key]['end'], n))
+        for key in key_set}
+    sums = {key: [0, np.zeros(n_chan), np.zeros((n_chan, n_chan)), None]
+        for key in key_set}
+
+    lo = min(b[0] for b in bounds.values())
+    hi = max(b[1] for b in bounds.values())
+    for a in range(lo, hi, block_size):
+        b = min(a + block_size, hi)
+        block = np.asarray(data[:, a:b], dtype=np.float64)
+        for key in key_set:
+            start, end = bounds[key]
+            if end <= a or start >= b: continue
+            _accumulate(sums[key], block[:, max(start, a) - a:min(end, b) - a])
+
+    return {key: _correlation_from_sums(*sums[key]) for key in key_set}
+
+def lagged_xcorr(data, max_lag):
+    """
+    Computes the normalized cross-correlation between all pairs of channels of
+    a (C, N) array for lags -max_lag..max_lag samples, using FFTs.
+
+    Returns a (C, C, 2 * max_lag + 1) array r where r[i, j, max_lag + k] is the
+    correlation of channel i shifted by k samples with channel j:
+        sum_t x_i[t + k] * x_j[t] / sqrt(sum_t x_i[t]^2 * sum_t x_j[t]^2)
+    with each channel's mean removed. r[:, :, max_lag] is
+    channel_correlation(data).
+    """
+    from scipy.fft import irfft, next_fast_len, rfft
+
+    x = np.asarray(data, dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+    n_chan, n = x.shape
+    nfft = next_fast_len(n + max_lag)
+    spectra = rfft(x, n=nfft, axis=1)
+    norms = np.sqrt(np.sum(x * x, axis=1))
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    result = np.empty((n_chan, n_chan, lags.shape[0]))
+    # One channel at a time keeps the irfft output at (C, nfft).
+    for i in range(n_chan):
+        cross = irfft(spectra[i] * np.conj(spectra), n=nfft, axis=1)
+        result[i] = cross[:, lags] / (norms[i] * norms[:, None])
+
+    return result
+
+def _correlation_sums(data, block_size=None):
+    # Running [n, sum, sum of outer products, shift] over time, where the
+    # shift (the first block's mean) keeps the sums numerically stable for
+    # signals with a large DC offset.
+    sums = [0, 0, 0, None]
+    n = data.shape[-1]
+    step = n if block_size is None else block_size
+    for a in range(0, n, step):
+        _accumulate(sums, np.asarray(data[:, a:a + step], dtype=np.float64))
+    return sums
+
+def _accumulate(sums, block):
+    if sums[3] is None:
+        sums[3] = block.mean(axis=1)
+    centered = block - sums[3][:, None]
+    sums[0] += block.shape[1]
+    sums[1] = sums[1] + centered.sum(axis=1)
+    sums[2] = sums[2] + centered @ centered.T
+
+def _correlation_from_sums(n, s1, s2, shift):
+    cov = s2 - np.outer(s1, s1) / n
+    std = np.sqrt(np.diag(cov))
+    return cov / np.outer(std, std)
+
+def plot_fft(data_samples, labels=None, use_plotly=None, max_freq=None):
+    import spectral
+
+    # Truncate everything to the size of the smallest sample, and compute all
+    # spectra in one batched rfft.
+    with instrument.span('fft', slices=len(data_samples)):
+        freq, ffts = spectral.batch_fft(data_samples, fast_len=False,
+            max_freq=max_freq)
+    with instrument.span('plot'):
+        for i, fft in enumerate(ffts):
+            label = None if labels is None else labels[i]
+            if use_plotly is not None:
+                plot_data_plotly(fft, fig=use_plotly, label=label, freq=freq, xlabel='Frequency',
+                    ylabel='Power')
+            else:
+                plot_data(fft, label=label, freq=freq, xlabel='Frequency',
+                    ylabel='Power')
 
 def plot_conditions_fft(cond, data, keys=None, use_plotly=None):
     """
@@ -230,6 +587,7 @@ def plot_recording_raw(recs, rec, plotly_fig):
 
 
 def plotly_fft_and_raw(recs):
+    import plotly.graph_objects as go
     # Plot fft
     fig = go.Figure()
     plot_recording_conditions_fft(recs, {'006': [c for c in
@@ -241,6 +599,16 @@ def plotly_fft_and_raw(recs):
     plot_recording_raw(recs, '006', fig)
     fig.show()
 
+def get_condition_length(cond, key, n=None):
+    """
+    Returns the number of samples of the condition key, computed from its
+    start and end indexes alone. If n, the length of the recording, is given,
+    the condition is clipped to it the same way slicing would.
+    """
+    start, end, _ = slice(cond[key]['start'], cond[key]['end']).indices(
+        n if n is not None else max(cond[key]['end'], cond[key]['start']))
+    return max(end - start, 0)
+
 def get_min_length(recs, keys):
     """
     Get the minimum length of all the event conditions specified by the keys
@@ -250,15 +618,11 @@ def get_min_length(recs, keys):
     - keys: dictionary of rec_ids -> list of desired conditions
     """
 
-    slices = []
-
     min_len = -1
     for rec_id in keys:
+        n = recs[rec_id]['data'].shape[-1]
         for condition in keys[rec_id]:
-            cond_slice = get_condition_slice(recs[rec_id]['cond'], condition,
-                                                recs[rec_id]['data']) 
-            slices.append(cond_slice)
-            slice_size = cond_slice.shape[0]
+            slice_size = get_condition_length(recs[rec_id]['cond'], condition, n)
             print('<' + rec_id + ': ' + condition + '> has length ' + str(slice_size))
 
             if slice_size < min_len or min_len == -1:
@@ -288,9 +652,8 @@ def custom_condition_keys(recs):
             # key=lambda x: recs['006']['cond'][x]['start'])
     # base_keys = {'006': rec_keys_sorted}
 
-    rec_keys = [c for c in recs['013']['cond']]
-    rec_keys_sorted = sorted(rec_keys, 
-            key=lambda x: recs['013']['cond'][x]['start'])
+    # Condition tables are sorted by start
+    rec_keys_sorted = list(conditions.as_table(recs['013']['cond']).labels)
     base_keys = {'013': rec_keys_sorted}
 
     no_breathe = {'006': ['hold breath'], '007': ['hold breath'], '003': ['no breathing']}
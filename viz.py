@@ -4,10 +4,29 @@ import numpy as np
 import plotly.graph_objects as go
 import matplotlib.pyplot as plt
 
+import conditions
+import envelope
+import spectral
+
 SAMPLE_RATE = 30000 # samples / s
 
-def spec_plot(Sxx, t, f, events=None):
-    plt.pcolormesh(t, f, np.log(Sxx))
+def spec_plot(Sxx, t=None, f=None, events=None, start_s=None, end_s=None,
+        max_columns=4000):
+    """
+    Plots a spectrogram, e.g. from spectral.compute_spectrogram. Sxx may also
+    be the path of a spectrogram saved by compute_spectrogram, which is then
+    read lazily: only the columns between start_s and end_s seconds are read,
+    and at most max_columns of them are plotted.
+    """
+    if isinstance(Sxx, str):
+        Sxx, t, f = spectral.load_spectrogram(Sxx)
+
+    a, b = np.searchsorted(t, [start_s if start_s is not None else t[0],
+        end_s if end_s is not None else t[-1]], side='left')
+    step = max(1, -(-(b + 1 - a) // max_columns))
+    cols = slice(a, b + 1, step)
+
+    plt.pcolormesh(t[cols], f, np.log(Sxx[:, cols]))
 
     if events is not None:
         for ev in events:
@@ -15,18 +34,31 @@ def spec_plot(Sxx, t, f, events=None):
 
     plt.show()
 
-def matplotlib_full_raw(recs, key, show=True, new_data=None):
+def matplotlib_full_raw(recs, key, show=True, new_data=None, width_px=2000):
+    """
+    Plots the full raw data of a recording with its events. Long recordings
+    are drawn from their min/max envelope pyramid (see envelope.py) at
+    width_px resolution instead of sample by sample.
+    """
     rec = recs[key]
     data = rec['data']
     events = rec['cond']
-    n = data.shape[0]
 
     if new_data is not None:
-        xticks = [x / SAMPLE_RATE for x in range(new_data.shape[0])]
-        plt.plot(xticks, new_data, label='raw data')
+        levels = envelope.build_envelope_pyramid(new_data)
+        x, y_min, y_max = envelope.get_span(new_data, levels, width_px=width_px)
     else:
-        xticks = [x / SAMPLE_RATE for x in range(n)]
-        plt.plot(xticks, data, label='raw data')
+        levels = envelope.get_envelope_pyramid(rec)
+        x, y_min, y_max = envelope.get_span(data, levels, width_px=width_px)
+
+    # (C, N) multi-channel data is plotted as one line per channel.
+    xticks = x / SAMPLE_RATE
+    if y_max is None:
+        plt.plot(xticks, y_min.T, label='raw data')
+    else:
+        for lo, hi in zip(np.atleast_2d(y_min), np.atleast_2d(y_max)):
+            plt.fill_between(xticks, lo, hi, step='post', linewidth=0.5,
+                label='raw data')
 
     for ev in events:
         start = events[ev]['start'] / SAMPLE_RATE
@@ -53,61 +85,72 @@ def matplotlib_snippet(data, start_s, end_s, key=None):
     # plt.legend()
     plt.show()
 
-def plotly_raw_with_events(rec, start=None, end=None):
+def plotly_raw_with_events(rec, start=None, end=None, width_px=2000):
     """
     Plots the raw data with event conditions as line segments at the bottom.
     Accepts a single recording dictionary. For example, if recs has the keys
     '001', '002', '003', you would pass recs['001'] as the first argument to
     plot from recording 001. 
 
-    Optionally, one can include a start and end sample index. This is highly
-    recommended due to how slow plotly can be when plotting large amounts of
-    data.
+    Optionally, one can include a start and end sample index. Spans with more
+    than 2 * width_px samples are drawn as their min/max envelope (see
+    envelope.get_span), so even the full recording plots quickly.
     """
 
     fig = go.Figure()
 
     # Prepare data
     data = rec['data']
-    use_data = data
-    x_ticks = np.arange(data.shape[0])
     if start is not None and end is not None:
 
         if start < 0:
             print("ERROR: start idx must be > 0.")
             return
-        if end > data.shape[0]:
+        if end > data.shape[-1]:
             print("ERROR: end idx must be less than size of raw data array. ")
             return
 
-        use_data = data[start:end]
-        x_ticks = x_ticks[start:end]
-
-    fig.add_trace(go.Scatter(x=x_ticks, y=use_data, 
-        name='Raw signal',
-        mode='lines'))
+    levels = envelope.get_envelope_pyramid(rec)
+    x_ticks, use_data, y_max = envelope.get_span(data, levels,
+        start if start is not None else 0, end, width_px)
+
+    if y_max is not None:
+        # Draw the envelope as a line alternating between each bin's min and
+        # max, which looks like the raw signal at this zoom level.
+        x_ticks = np.repeat(x_ticks, 2)
+        use_data = np.stack([use_data, y_max], axis=-1).reshape(
+            use_data.shape[:-1] + (-1,))
+
+    # (C, N) multi-channel data is plotted as one trace per channel.
+    rows = np.atleast_2d(use_data)
+    for c, row in enumerate(rows):
+        name = 'Raw signal'
+        if rows.shape[0] > 1:
+            name = rec['channels'][c]['label'] if 'channels' in rec \
+                else 'Channel ' + str(c)
+        fig.add_trace(go.Scatter(x=x_ticks, y=row,
+            name=name,
+            mode='lines'))
     fig.update_layout(xaxis_title='sample # (sample rate: 30 kHz)',
             yaxis_title='uV')
 
     # Draw the event durations at the minumum y value
     min_y = np.min(use_data)
 
-    events = rec['cond']
-    for event in events:
-        xvals = []
-        start_val = events[event]['start']
-        end_val = events[event]['end']
-
-        # Only plot the event conditions nearby the window bounded by start and
-        # end idx.
-        if (start is None and end is None) or \
-            (start_val >= start and end_val <= end) or \
-            (start_val <= end and end_val >= start):
-            xvals.append(start_val)
-            xvals.append(end_val)
-
-            fig.add_trace(go.Scatter(x=xvals, y=np.ones(len(xvals)) * min_y, 
-                name=event))
+    # Only plot the event conditions overlapping the window bounded by start
+    # and end idx.
+    events = conditions.as_table(rec['cond'])
+    if start is None and end is None:
+        idx = np.arange(len(events))
+    else:
+        idx = events.overlapping(start if start is not None else 0,
+            end if end is not None else data.shape[-1])
+
+    for i in idx:
+        xvals = [events.starts[i], events.ends[i]]
+
+        fig.add_trace(go.Scatter(x=xvals, y=np.ones(len(xvals)) * min_y, 
+            name=events.labels[i]))
 
     fig.show()
     return fig